@@ -0,0 +1,77 @@
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
+from utils.cache_utils import coalesced_invalidation, invalidate_model_caches
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def handler(event_type):
+    """
+    Register a function handling a batch of events of the given type.
+    The function receives the list of payloads in publish order.
+    """
+    def decorator(func):
+        _handlers[event_type] = func
+        return func
+    return decorator
+
+
+def dispatch(events):
+    """
+    Run the handlers for a batch of events.
+
+    Args:
+        events (list): (event_type, payload) tuples in publish order
+    """
+    payloads_by_type = defaultdict(list)
+    for event_type, payload in events:
+        payloads_by_type[event_type].append(payload)
+
+    for event_type, payloads in payloads_by_type.items():
+        func = _handlers.get(event_type)
+        if func is None:
+            logger.error(f"No handler registered for event type {event_type}")
+            continue
+        func(payloads)
+
+
+@handler('cache.invalidate')
+def handle_cache_invalidation(payloads):
+    # Apply the whole batch as one deduplicated invalidation
+    with coalesced_invalidation():
+        for payload in payloads:
+            invalidate_model_caches(payload['model_name'], payload.get('instance_id'), payload.get('related_models'))
+
+
+@handler('purchase.recorded')
+def handle_purchase_recorded(payloads):
+    from package.models import UserPurchaseStats
+
+    # Fold all purchases of a user into a single update
+    totals = defaultdict(lambda: [Decimal('0'), 0, 0])
+    for payload in payloads:
+        user_totals = totals[payload['user_id']]
+        user_totals[0] += Decimal(payload['total_price'])
+        user_totals[1] += payload['quantity']
+        user_totals[2] += payload['purchases']
+
+    for user_id, (total_price, quantity, purchases) in totals.items():
+        UserPurchaseStats.record_purchase(user_id, total_price, quantity, purchases=purchases)
+
+
+@handler('provider_stats.delta')
+def handle_provider_stats_delta(payloads):
+    from product.models import ProviderStats
+
+    ProviderStats.apply_deltas([row for payload in payloads for row in payload['rows']])
+
+
+@handler('provider_stats.recount')
+def handle_provider_stats_recount(payloads):
+    from product.models import ProviderStats
+
+    ProviderStats.recount_packaged([pair for payload in payloads for pair in payload['pairs']])
@@ -0,0 +1,77 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from events.handlers import dispatch
+from events.models import OutboxEvent
+
+
+class Command(BaseCommand):
+    help = 'Handle pending outbox events (EVENT_OUTBOX_ENABLED) in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Maximum number of events handled per batch.')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when there are no pending events.')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='Mark an event as failed after this many attempts.')
+        parser.add_argument('--once', action='store_true',
+                            help='Handle the pending events once and exit instead of polling.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        while True:
+            handled = self.dispatch_batch(batch_size, options['max_attempts'])
+            if handled:
+                self.stdout.write(f"Handled {handled} events")
+                if handled == batch_size:
+                    continue
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+    def dispatch_batch(self, batch_size, max_attempts):
+        with transaction.atomic():
+            events = list(
+                OutboxEvent.objects
+                .select_for_update(skip_locked=True)
+                .filter(status='pending')
+                .order_by('id')[:batch_size]
+            )
+            if not events:
+                return 0
+
+            try:
+                # Savepoint, so a failing handler's database writes are rolled back
+                with transaction.atomic():
+                    dispatch([(event.event_type, event.payload) for event in events])
+                handled = events
+            except Exception as e:
+                self.stderr.write(f"Failed to handle batch, retrying events one by one: {str(e)}")
+                handled = self.dispatch_one_by_one(events, max_attempts)
+
+            OutboxEvent.objects.filter(id__in=[event.id for event in handled]).delete()
+            return len(handled)
+
+    def dispatch_one_by_one(self, events, max_attempts):
+        handled = []
+        failed = []
+        for event in events:
+            try:
+                with transaction.atomic():
+                    dispatch([(event.event_type, event.payload)])
+                handled.append(event)
+            except Exception as e:
+                self.stderr.write(f"Failed to handle event {event.id}: {str(e)}")
+                event.attempts += 1
+                event.last_error = str(e)
+                if event.attempts >= max_attempts:
+                    event.status = 'failed'
+                failed.append(event)
+
+        if failed:
+            OutboxEvent.objects.bulk_update(failed, ['attempts', 'last_error', 'status'])
+        return handled
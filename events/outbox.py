@@ -0,0 +1,32 @@
+from django.conf import settings
+
+from .handlers import dispatch
+from .models import OutboxEvent
+
+
+def publish(event_type, payload):
+    """
+    Record a side effect of the current write.
+
+    With EVENT_OUTBOX_ENABLED the event is stored in the outbox table as part of the
+    current database transaction and handled later by the dispatch_events command.
+    Otherwise it is handled in-process right away, inside the current transaction
+    (cache invalidations are still deferred until commit by invalidate_model_caches).
+
+    Args:
+        event_type (str): A type registered with events.handlers.handler
+        payload (dict): JSON serializable event data
+    """
+    if settings.EVENT_OUTBOX_ENABLED:
+        OutboxEvent.objects.create(event_type=event_type, payload=payload)
+    else:
+        dispatch([(event_type, payload)])
+
+
+def publish_cache_invalidation(model_name, instance_id=None, related_models=None):
+    """Publish an invalidate_model_caches call as an event"""
+    publish('cache.invalidate', {
+        'model_name': model_name,
+        'instance_id': instance_id,
+        'related_models': related_models,
+    })
@@ -66,12 +66,14 @@ INSTALLED_APPS = [
     'authorization',
     'product',
     'package',
+    'events',
     'django_filters',
 ]
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django_prometheus.middleware.PrometheusBeforeMiddleware',
+    'utils.cache_middleware.CacheInvalidationMiddleware',  # Apply cache invalidations once per request
 
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -195,6 +197,74 @@ CSRF_TRUSTED_ORIGINS = [origin.strip() for origin in get_conf('CSRF_TRUSTED_ORIG
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Where uploaded images are stored:
+# 'local': MEDIA_ROOT
+# 'local-object': MEDIA_ROOT, with the presigned direct uploads of 's3', for development
+# 's3': an S3 compatible object store (needs boto3), configured with the IMAGE_S3_* variables
+IMAGE_STORAGE_BACKEND = os.environ.get('IMAGE_STORAGE_BACKEND', 'local')
+IMAGE_STORAGE_URL_EXPIRY = int(os.environ.get('IMAGE_STORAGE_URL_EXPIRY', '3600'))
+IMAGE_STORAGES = {
+    'local': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'local-object': {
+        'BACKEND': 'utils.storage.LocalObjectStorage',
+        'OPTIONS': {'url_expiry': IMAGE_STORAGE_URL_EXPIRY},
+    },
+    's3': {
+        'BACKEND': 'utils.storage.S3Storage',
+        'OPTIONS': {
+            'bucket_name': os.environ.get('IMAGE_S3_BUCKET'),
+            'endpoint_url': os.environ.get('IMAGE_S3_ENDPOINT_URL'),
+            'region_name': os.environ.get('IMAGE_S3_REGION'),
+            'access_key': os.environ.get('IMAGE_S3_ACCESS_KEY'),
+            'secret_key': os.environ.get('IMAGE_S3_SECRET_KEY'),
+            'location': os.environ.get('IMAGE_S3_LOCATION', ''),
+            'url_expiry': IMAGE_STORAGE_URL_EXPIRY,
+        },
+    },
+}
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'images': IMAGE_STORAGES[IMAGE_STORAGE_BACKEND],
+}
+
+# How image downloads are served: 'django' streams the file from the worker,
+# 'x-accel-redirect' (nginx) and 'x-sendfile' (Apache/lighttpd) hand it to the front proxy,
+# 'redirect' sends the client to the storage URL (presigned with 's3' storage)
+IMAGE_SERVE_MODE = os.environ.get('IMAGE_SERVE_MODE', 'django')
+# Internal nginx location mapped to MEDIA_ROOT, used with x-accel-redirect
+IMAGE_ACCEL_REDIRECT_PREFIX = os.environ.get('IMAGE_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+# max-age of image downloads without ?v=<content hash>, versioned URLs are cached as immutable
+IMAGE_CACHE_MAX_AGE = 3600
+
+# Limits of uploaded images
+IMAGE_UPLOAD_MAX_SIZE = 20 * 1024 * 1024
+IMAGE_UPLOAD_MAX_PIXELS = 50_000_000
+IMAGE_UPLOAD_ALLOWED_TYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/gif']
+# Chunked uploads (image/upload/init/): largest chunk accepted per request, where the
+# received bytes are kept, and how long an idle upload can be resumed
+IMAGE_UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+IMAGE_UPLOAD_TEMP_DIR = os.environ.get('IMAGE_UPLOAD_TEMP_DIR', str(BASE_DIR / 'tmp' / 'image_uploads'))
+IMAGE_UPLOAD_EXPIRY = timedelta(days=1)
+# Images no product or package refers to are deleted by `python manage.py gc_images`
+# once they haven't been uploaded for this long
+IMAGE_GC_GRACE = timedelta(days=2)
+
+# Serve image downloads and uploads with async views, for ASGI deployments (khoshback.asgi).
+# Their blocking file I/O runs in a pool of IMAGE_ASYNC_IO_WORKERS threads
+IMAGE_ASYNC_VIEWS = os.environ.get('IMAGE_ASYNC_VIEWS', 'False') in ['true', 'True']
+IMAGE_ASYNC_IO_WORKERS = int(os.environ.get('IMAGE_ASYNC_IO_WORKERS', '32'))
+
+# Resized copies generated for every uploaded image, served with image/<id>/download/?w=&fmt=
+IMAGE_VARIANT_WIDTHS = [320, 640, 1280]
+# Formats this Pillow build can't encode (AVIF without a plugin) are skipped
+IMAGE_VARIANT_FORMATS = ['webp', 'avif']
+IMAGE_VARIANT_QUALITY = 80
+# Size of the process pool rendering variants, 0 renders them in the web process
+IMAGE_VARIANT_WORKERS = int(os.environ.get('IMAGE_VARIANT_WORKERS', '2'))
+
 # Cache settings
 CACHES = {
     'default': {
@@ -210,6 +280,32 @@ CACHE_MIDDLEWARE_SECONDS = 300
 
 CACHE_TTL = 300
 
+# Package ratings
+# Weighted (Bayesian) rating = (prior_mean * prior_weight + sum) / (prior_weight + count)
+RATING_PRIOR_MEAN = 3.0
+RATING_PRIOR_WEIGHT = 5
+# Buffer rating submissions in a Redis stream and apply them in batches
+# with `python manage.py process_rating_queue`
+RATING_WRITE_BEHIND = os.environ.get('RATING_WRITE_BEHIND', 'False') in ['true', 'True']
+
+# Event outbox
+# When enabled, side effects of writes (cache invalidation, aggregate updates) are stored in
+# the outbox table and handled by `python manage.py dispatch_events`; otherwise they run on commit.
+EVENT_OUTBOX_ENABLED = os.environ.get('EVENT_OUTBOX_ENABLED', 'False') in ['true', 'True']
+
+# Transactions
+# Pending transactions older than this are cancelled by `python manage.py expire_transactions`
+PENDING_TRANSACTION_TTL = timedelta(minutes=30)
+# Cancelled transactions older than this are moved to ArchivedTransaction
+TRANSACTION_ARCHIVE_AFTER = timedelta(days=30)
+
+# Product import
+# Rows validated and written per batch by the bulk import endpoint
+PRODUCT_IMPORT_CHUNK_SIZE = 1000
+PRODUCT_IMPORT_MAX_ROWS = 100000
+# Soft deleted products older than this are hard deleted by `python manage.py purge_products`
+PRODUCT_PURGE_AFTER = timedelta(days=7)
+
 # Logging configuration
 LOGGING = {
     'version': 1,
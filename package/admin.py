@@ -1,5 +1,10 @@
 from django.contrib import admin
-from .models import TripPackage
+from .models import PackagePhoto, TripPackage
+
+class PackagePhotoInline(admin.TabularInline):
+    model = PackagePhoto
+    raw_id_fields = ('image',)
+    extra = 0
 
 @admin.register(TripPackage)
 class TripPackageAdmin(admin.ModelAdmin):
@@ -8,6 +13,7 @@ class TripPackageAdmin(admin.ModelAdmin):
     search_fields = ('name', 'description')
     readonly_fields = ('created_at', 'updated_at', 'rating',)
     filter_horizontal = ('activities',)
+    inlines = [PackagePhotoInline]
     
     fieldsets = (
         ('Basic Information', {
@@ -16,9 +22,6 @@ class TripPackageAdmin(admin.ModelAdmin):
         ('Dates', {
             'fields': ('start_date', 'end_date')
         }),
-        ('Media', {
-            'fields': ('photos',)
-        }),
         ('Products', {
             'fields': ('flight', 'hotel', 'activities')
         }),
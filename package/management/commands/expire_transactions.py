@@ -0,0 +1,87 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from package.models import Transaction, ArchivedTransaction
+
+ARCHIVED_FIELDS = (
+    'id', 'transaction_id', 'user_id', 'package_id', 'created_at',
+    'status', 'quantity', 'purchase_date', 'card_number',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Cancel pending transactions older than PENDING_TRANSACTION_TTL and move old '
+        'cancelled transactions into ArchivedTransaction, in batches.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl-minutes', type=int, default=None,
+                            help='Override PENDING_TRANSACTION_TTL.')
+        parser.add_argument('--archive-after-days', type=int, default=None,
+                            help='Override TRANSACTION_ARCHIVE_AFTER.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows updated or moved per statement.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, repeating every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=60.0,
+                            help='Seconds between runs with --loop.')
+
+    def handle(self, *args, **options):
+        ttl = settings.PENDING_TRANSACTION_TTL
+        if options['ttl_minutes'] is not None:
+            ttl = timedelta(minutes=options['ttl_minutes'])
+        archive_after = settings.TRANSACTION_ARCHIVE_AFTER
+        if options['archive_after_days'] is not None:
+            archive_after = timedelta(days=options['archive_after_days'])
+
+        while True:
+            expired = self.expire_pending(timezone.now() - ttl, options['batch_size'])
+            archived = self.archive(timezone.now() - archive_after, options['batch_size'])
+            self.stdout.write(f"Expired {expired} pending transactions, archived {archived} transactions")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def expire_pending(self, cutoff, batch_size):
+        total = 0
+        while True:
+            ids = list(
+                Transaction.objects
+                .filter(status='pending', created_at__lt=cutoff)
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                return total
+            # Cancelling doesn't change anything clients see, so no cache invalidation is needed
+            total += Transaction.objects.filter(id__in=ids, status='pending').update(status='cancelled')
+
+    def archive(self, cutoff, batch_size):
+        """
+        Move cancelled transactions, and completed ones without a purchase history,
+        into the archive. Completed transactions referenced by PurchaseHistory stay
+        in place since the history row points at them.
+        """
+        total = 0
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    Transaction.objects
+                    .filter(created_at__lt=cutoff, status__in=['cancelled', 'completed'], purchase_history__isnull=True)
+                    .values(*ARCHIVED_FIELDS)[:batch_size]
+                )
+                if not rows:
+                    return total
+
+                ArchivedTransaction.objects.bulk_create([
+                    ArchivedTransaction(**{field: row[field] for field in ARCHIVED_FIELDS if field != 'id'})
+                    for row in rows
+                ])
+                Transaction.objects.filter(id__in=[row['id'] for row in rows]).delete()
+            total += len(rows)
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from package.rating_buffer import (
+    _get_redis_client,
+    acknowledge_queued_ratings,
+    apply_ratings,
+    read_queued_ratings,
+)
+
+
+class Command(BaseCommand):
+    help = 'Apply rating submissions buffered in Redis (RATING_WRITE_BEHIND) in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Maximum number of queued ratings folded per batch.')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue once and exit instead of polling.')
+
+    def handle(self, *args, **options):
+        if _get_redis_client() is None:
+            raise CommandError('The rating queue requires the Redis cache backend.')
+
+        batch_size = options['batch_size']
+        while True:
+            entry_ids, ratings = read_queued_ratings(batch_size)
+            if entry_ids:
+                updated_packages = apply_ratings(ratings)
+                acknowledge_queued_ratings(entry_ids)
+                self.stdout.write(
+                    f"Applied {len(ratings)} ratings to {len(updated_packages)} packages"
+                )
+                if len(entry_ids) == batch_size:
+                    continue
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,80 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:23
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_rating_histogram(apps, schema_editor):
+    TripPackage = apps.get_model('package', 'TripPackage')
+    PackageRating = apps.get_model('package', 'PackageRating')
+
+    histograms = {}
+    for row in PackageRating.objects.values('package_id', 'rating').annotate(total=Count('id')):
+        histograms.setdefault(row['package_id'], {})[row['rating']] = row['total']
+
+    prior_mean = settings.RATING_PRIOR_MEAN
+    prior_weight = settings.RATING_PRIOR_WEIGHT
+    packages = []
+    for package in TripPackage.objects.filter(id__in=histograms.keys()).iterator():
+        histogram = histograms[package.id]
+        for star in range(1, 6):
+            setattr(package, f'ratings_{star}', histogram.get(star, 0))
+        package.ratings_count = sum(histogram.values())
+        package.ratings_sum = sum(star * count for star, count in histogram.items())
+        package.rating = package.ratings_sum / package.ratings_count
+        package.weighted_rating = (prior_mean * prior_weight + package.ratings_sum) / (prior_weight + package.ratings_count)
+        packages.append(package)
+
+    TripPackage.objects.bulk_update(
+        packages,
+        ['ratings_1', 'ratings_2', 'ratings_3', 'ratings_4', 'ratings_5',
+         'ratings_count', 'ratings_sum', 'rating', 'weighted_rating'],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0005_merge_20250304_2118'),
+        ('product', '0003_product_discount_alter_product_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trippackage',
+            name='ratings_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='trippackage',
+            name='ratings_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='trippackage',
+            name='ratings_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='trippackage',
+            name='ratings_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='trippackage',
+            name='ratings_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='trippackage',
+            name='weighted_rating',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddIndex(
+            model_name='trippackage',
+            index=models.Index(fields=['-weighted_rating', '-ratings_count'], name='package_weighted_rating_idx'),
+        ),
+        migrations.RunPython(backfill_rating_histogram, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_user_purchase_stats(apps, schema_editor):
+    PurchaseHistory = apps.get_model('package', 'PurchaseHistory')
+    UserPurchaseStats = apps.get_model('package', 'UserPurchaseStats')
+
+    totals = PurchaseHistory.objects.values('user_id').annotate(
+        total_spent=Sum('total_price'),
+        purchases_count=Count('id'),
+        units_count=Sum('quantity'),
+    )
+    UserPurchaseStats.objects.bulk_create(
+        [UserPurchaseStats(**row) for row in totals],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authorization', '0002_alter_baseuser_role'),
+        ('package', '0006_trippackage_rating_histogram'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPurchaseStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='purchase_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total_spent', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('purchases_count', models.PositiveIntegerField(default=0)),
+                ('units_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='purchasehistory',
+            index=models.Index(fields=['user', '-purchase_date'], name='purchase_history_user_date_idx'),
+        ),
+        migrations.RunPython(backfill_user_purchase_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def _clean_image_ids(value):
+    ids = []
+    for image_id in value if isinstance(value, list) else []:
+        try:
+            ids.append(int(image_id))
+        except (TypeError, ValueError):
+            pass
+    return ids
+
+
+def backfill_package_photos(apps, schema_editor):
+    # Packages are read in ID order, BATCH_SIZE at a time, IDs of deleted images are dropped
+    TripPackage = apps.get_model('package', 'TripPackage')
+    PackagePhoto = apps.get_model('package', 'PackagePhoto')
+    Image = apps.get_model('product', 'Image')
+
+    last_id = 0
+    while True:
+        rows = list(
+            TripPackage.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'photos')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        rows = [(package_id, _clean_image_ids(photos)) for package_id, photos in rows]
+        existing = set(Image.objects.filter(
+            id__in={image_id for _, photos in rows for image_id in photos}
+        ).values_list('id', flat=True))
+        PackagePhoto.objects.bulk_create([
+            PackagePhoto(package_id=package_id, image_id=image_id, position=position)
+            for package_id, photos in rows
+            for position, image_id in enumerate(image_id for image_id in photos if image_id in existing)
+        ], batch_size=BATCH_SIZE)
+
+
+def restore_package_photos(apps, schema_editor):
+    TripPackage = apps.get_model('package', 'TripPackage')
+    PackagePhoto = apps.get_model('package', 'PackagePhoto')
+
+    photos = {}
+    links = PackagePhoto.objects.order_by('package_id', 'position').values_list('package_id', 'image_id')
+    for package_id, image_id in links.iterator(chunk_size=BATCH_SIZE):
+        photos.setdefault(package_id, []).append(image_id)
+    for package_id, image_ids in photos.items():
+        TripPackage.objects.filter(id=package_id).update(photos=image_ids)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0008_transaction_expiry_archive'),
+        ('product', '0014_productimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackagePhoto',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='package_links', to='product.image')),
+                ('package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photo_links', to='package.trippackage')),
+            ],
+            options={
+                'ordering': ['position'],
+                'constraints': [models.UniqueConstraint(fields=('package', 'position'), name='package_photo_position_unique')],
+            },
+        ),
+        migrations.RunPython(backfill_package_photos, restore_package_photos),
+    ]
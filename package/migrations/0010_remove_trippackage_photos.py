@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:09
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0009_packagephoto'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='trippackage',
+            name='photos',
+        ),
+    ]
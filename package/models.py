@@ -2,19 +2,20 @@ from django.db import models
 from django.core.validators import MinValueValidator
 from django.utils import timezone
 from django.core.cache import cache
-from utils.cache_utils import invalidate_model_caches
+from events.outbox import publish, publish_cache_invalidation
+from utils.model_tracking import FieldTrackerMixin
 
 from authorization.models import BaseUser
-from product.models import Product, Image
+from product.models import Product, Image, publish_packaged_recount, set_image_links
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db.models import F, Q
+from django.db.models.base import DEFERRED
 from django.conf import settings
 
 User = get_user_model()
 
-class TripPackage(models.Model):
+class TripPackage(FieldTrackerMixin, models.Model):
     name = models.CharField(max_length=100)
-    photos = models.JSONField(default=list)  # List of image IDs
     flight = models.ForeignKey(Product, on_delete=models.PROTECT, related_name='flight_packages', limit_choices_to={'category': 'flight'})
     hotel = models.ForeignKey(Product, on_delete=models.PROTECT, related_name='hotel_packages', limit_choices_to={'category': 'hotel'})
     activities = models.ManyToManyField(Product, blank=True, related_name='activity_packages', limit_choices_to={'category__in': ['tourism', 'restaurant']})
@@ -30,42 +31,119 @@ class TripPackage(models.Model):
     rating = models.FloatField(default=0.0)
     ratings_count = models.PositiveIntegerField(default=0)
     ratings_sum = models.FloatField(default=0.0)
+    # Star histogram, kept in sync incrementally by update_rating()
+    ratings_1 = models.PositiveIntegerField(default=0)
+    ratings_2 = models.PositiveIntegerField(default=0)
+    ratings_3 = models.PositiveIntegerField(default=0)
+    ratings_4 = models.PositiveIntegerField(default=0)
+    ratings_5 = models.PositiveIntegerField(default=0)
+    # Bayesian average used for "top rated" sorting
+    weighted_rating = models.FloatField(default=0.0)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-weighted_rating', '-ratings_count'], name='package_weighted_rating_idx'),
+        ]
+
+    # Fields exposed by the package serializers; saves that change none of them keep the caches
+    tracked_fields = (
+        'name', 'flight_id', 'hotel_id', 'price', 'start_date', 'end_date',
+        'available_units', 'published', 'description', 'created_at',
+        'rating', 'ratings_count', 'weighted_rating',
+    )
+
+    RATING_AGGREGATE_FIELDS = [
+        'rating', 'ratings_count', 'ratings_sum', 'weighted_rating', 'updated_at',
+        'ratings_1', 'ratings_2', 'ratings_3', 'ratings_4', 'ratings_5',
+    ]
 
     def clean(self):
         from django.core.exceptions import ValidationError
         if self.start_date and self.end_date and self.start_date >= self.end_date:
             raise ValidationError('Start date must be before end date')
 
-    def update_rating(self, new_rating: int):
+    @staticmethod
+    def compute_weighted_rating(ratings_sum, ratings_count):
         """
-        Update the package rating with a new integer rating (1-5).
+        Bayesian average of the ratings: the mean is pulled towards
+        RATING_PRIOR_MEAN until the package has collected enough ratings.
         """
-        # update cumulative sum and count
-        ratings = self.user_ratings.all()  # related_name from PackageRating
-        self.ratings_count = ratings.count()
-        self.ratings_sum = sum(r.rating for r in ratings)
+        if not ratings_count:
+            return 0.0
+        prior_mean = settings.RATING_PRIOR_MEAN
+        prior_weight = settings.RATING_PRIOR_WEIGHT
+        return (prior_mean * prior_weight + ratings_sum) / (prior_weight + ratings_count)
+
+    @property
+    def rating_histogram(self):
+        return {str(star): getattr(self, f'ratings_{star}') for star in range(1, 6)}
+
+    def apply_rating(self, new_rating: int, old_rating: int = None):
+        """
+        Fold a single integer rating (1-5) into the in-memory aggregates without saving.
+        If old_rating is given, the user's previous rating is replaced instead of adding a new one.
+        """
+        if old_rating is not None:
+            setattr(self, f'ratings_{old_rating}', getattr(self, f'ratings_{old_rating}') - 1)
+            self.ratings_sum -= old_rating
+        else:
+            self.ratings_count += 1
+
+        setattr(self, f'ratings_{new_rating}', getattr(self, f'ratings_{new_rating}') + 1)
+        self.ratings_sum += new_rating
         self.rating = self.ratings_sum / self.ratings_count if self.ratings_count else 0.0
-        self.save()
+        self.weighted_rating = self.compute_weighted_rating(self.ratings_sum, self.ratings_count)
+
+    def save_rating_aggregates(self):
+        self.save(update_fields=self.RATING_AGGREGATE_FIELDS)
+
+    def update_rating(self, new_rating: int, old_rating: int = None):
+        """
+        Update the package rating with a new integer rating (1-5).
+        """
+        self.apply_rating(new_rating, old_rating=old_rating)
+        self.save_rating_aggregates()
 
     def save(self, *args, **kwargs):
-        # Clear cache when a package is saved or updated
+        # Clear cache when a visible field of the package is saved or updated
         self.clean()
+        update_fields = kwargs.get('update_fields')
+        visible_change = self.has_tracked_changes(update_fields)
+        # Products that start or stop being used by this package
+        packaged_products = set()
+        for field in ('flight_id', 'hotel_id'):
+            if self._state.adding or (
+                (update_fields is None or self._field_in(field, update_fields)) and self.has_changed(field)
+            ):
+                packaged_products.update({self.get_original_value(field), getattr(self, field)} - {DEFERRED})
         super().save(*args, **kwargs)
         
-        invalidate_model_caches('package', self.id, related_models=['product'])
+        if visible_change:
+            publish_cache_invalidation('package', self.id, related_models=['product'])
+        publish_packaged_recount(packaged_products)
 
     def delete(self, *args, **kwargs):
         package_id = self.id
+        packaged_products = [self.flight_id, self.hotel_id] + list(self.activities.values_list('id', flat=True))
         super().delete(*args, **kwargs)
         
-        invalidate_model_caches('package', package_id, related_models=['product'])
+        publish_cache_invalidation('package', package_id, related_models=['product'])
+        publish_packaged_recount(packaged_products)
 
     def __str__(self):
         return self.name
 
+    @property
+    def photo_ids(self):
+        """IDs of the package's photos in order, from the prefetched photo_links if loaded"""
+        return [link.image_id for link in self.photo_links.all()]
+
+    def set_photos(self, image_ids):
+        """Replace the package's photos with these image IDs, in that order"""
+        if set_image_links(self.photo_links, image_ids):
+            publish_cache_invalidation('package', self.id, related_models=['product'])
+
     @classmethod
     def filter_packages(cls, **kwargs):
         queryset = cls.objects.select_related('flight', 'hotel').prefetch_related('activities')
@@ -104,10 +182,27 @@ class TripPackage(models.Model):
                 queryset = queryset.order_by('price')
             elif sort_by == 'date':
                 queryset = queryset.order_by('start_date')
+            elif sort_by == 'rating':
+                queryset = queryset.order_by('-weighted_rating', '-ratings_count')
 
         return queryset
 
-class Transaction(models.Model):
+class PackagePhoto(models.Model):
+    """A photo of a trip package, `position` orders the photos as the API lists them"""
+    package = models.ForeignKey(TripPackage, on_delete=models.CASCADE, related_name='photo_links')
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='package_links')
+    position = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['package', 'position'], name='package_photo_position_unique'),
+        ]
+
+    def __str__(self):
+        return f"Package {self.package_id} photo {self.position}: {self.image_id}"
+
+class Transaction(FieldTrackerMixin, models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('completed', 'Completed'),
@@ -125,17 +220,51 @@ class Transaction(models.Model):
     purchase_date = models.DateTimeField(null=True, blank=True)  # Timestamp of the purchase confirmation
     card_number = models.CharField(max_length=16, null=True, blank=True)  # Last 4 digits of the card
 
+    tracked_fields = ('status',)
+
+    class Meta:
+        indexes = [
+            # Used by the expire_transactions command to find stale pending/cancelled rows
+            models.Index(fields=['status', 'created_at'], name='transaction_status_created_idx'),
+        ]
+
+    @property
+    def is_expired(self):
+        """Whether the transaction is still pending after PENDING_TRANSACTION_TTL."""
+        return self.status == 'pending' and self.created_at < timezone.now() - settings.PENDING_TRANSACTION_TTL
+
     def save(self, *args, **kwargs):
-        if self.pk:
-            old_instance = Transaction.objects.get(pk=self.pk)
-            if old_instance.status != 'completed' and self.status == 'completed':
-                invalidate_model_caches('package', self.package.id)
+        if self.pk and self.status == 'completed' and self.has_changed('status'):
+            old_status = self.get_original_value('status')
+            if old_status is DEFERRED:
+                # Not loaded from the database (or status was deferred), so look it up
+                old_status = Transaction.objects.filter(pk=self.pk).values_list('status', flat=True).first()
+            if old_status != 'completed':
+                publish_cache_invalidation('package', self.package_id)
         
         super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Transaction {self.transaction_id} - {self.status}"
 
+class ArchivedTransaction(models.Model):
+    """
+    Old cancelled (and never recorded completed) transactions moved out of the
+    Transaction table by the expire_transactions command, so the hot table stays small.
+    """
+    transaction_id = models.CharField(max_length=100, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_transactions')
+    package = models.ForeignKey('TripPackage', on_delete=models.CASCADE, related_name='archived_transactions')
+    created_at = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=Transaction.STATUS_CHOICES)
+    quantity = models.PositiveIntegerField(default=1)
+    purchase_date = models.DateTimeField(null=True, blank=True)
+    card_number = models.CharField(max_length=16, null=True, blank=True)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Archived transaction {self.transaction_id} - {self.status}"
+
 class PurchaseHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='purchase_history')
     package = models.ForeignKey('TripPackage', on_delete=models.CASCADE, related_name='purchase_history')
@@ -144,25 +273,82 @@ class PurchaseHistory(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-purchase_date'], name='purchase_history_user_date_idx'),
+        ]
+
     def save(self, *args, **kwargs):
+        is_new = self._state.adding
         super().save(*args, **kwargs)
+
+        if is_new:
+            publish('purchase.recorded', {
+                'user_id': self.user_id,
+                'total_price': str(self.total_price),
+                'quantity': self.quantity,
+                'purchases': 1,
+            })
         
-        invalidate_model_caches('purchase_history')
+        publish_cache_invalidation('purchase_history')
         
-        invalidate_model_caches('package', self.package.id)
+        publish_cache_invalidation('package', self.package_id)
     
     def delete(self, *args, **kwargs):
-        package_id = self.package.id
+        package_id = self.package_id
         super().delete(*args, **kwargs)
+
+        publish('purchase.recorded', {
+            'user_id': self.user_id,
+            'total_price': str(-self.total_price),
+            'quantity': -self.quantity,
+            'purchases': -1,
+        })
         
-        invalidate_model_caches('purchase_history')
+        publish_cache_invalidation('purchase_history')
         
-        invalidate_model_caches('package', package_id)
+        publish_cache_invalidation('package', package_id)
     
     def __str__(self):
         return f"Purchase by {self.user.email} - Package: {self.package.name}"
 
 
+class UserPurchaseStats(models.Model):
+    """
+    Per-user purchase totals, kept up to date from the 'purchase.recorded' events
+    PurchaseHistory publishes, so the purchase history page doesn't need to
+    aggregate the whole history.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='purchase_stats')
+    total_spent = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    purchases_count = models.PositiveIntegerField(default=0)
+    units_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def record_purchase(cls, user_id, total_price, quantity, purchases=1):
+        """
+        Add a purchase (or subtract one, with negative values) to the user's totals.
+        """
+        if purchases > 0:
+            _, created = cls.objects.get_or_create(
+                user_id=user_id,
+                defaults={'total_spent': total_price, 'purchases_count': purchases, 'units_count': quantity}
+            )
+            if created:
+                return
+
+        cls.objects.filter(user_id=user_id).update(
+            total_spent=F('total_spent') + total_price,
+            purchases_count=F('purchases_count') + purchases,
+            units_count=F('units_count') + quantity,
+            updated_at=timezone.now(),
+        )
+
+    def __str__(self):
+        return f"Purchase stats of {self.user}"
+
+
 class PackageRating(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     package = models.ForeignKey(TripPackage, on_delete=models.CASCADE, related_name="user_ratings")
@@ -0,0 +1,141 @@
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import TripPackage, PackageRating
+from .rating_cache import invalidate_package_ratings
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+RATING_STREAM_KEY = 'package_ratings:stream'
+
+
+def _get_redis_client():
+    """Get the Redis client from the cache backend"""
+    if hasattr(cache, 'client') and hasattr(cache.client, 'get_client'):
+        return cache.client.get_client()
+    return None
+
+
+def is_write_behind_enabled():
+    """
+    Ratings are only buffered when the setting is on and the cache backend is Redis,
+    otherwise they are applied synchronously.
+    """
+    return settings.RATING_WRITE_BEHIND and _get_redis_client() is not None
+
+
+def enqueue_rating(user_id, package_id, rating):
+    """
+    Append a rating submission to the Redis stream. It is folded into the
+    database later by the process_rating_queue management command.
+    """
+    redis_client = _get_redis_client()
+    return redis_client.xadd(RATING_STREAM_KEY, {
+        'user_id': user_id,
+        'package_id': package_id,
+        'rating': rating,
+    })
+
+
+def read_queued_ratings(batch_size):
+    """
+    Read up to batch_size queued ratings, oldest first.
+
+    Returns:
+        tuple: (entry_ids, ratings) where ratings is a list of (user_id, package_id, rating)
+    """
+    redis_client = _get_redis_client()
+    entries = redis_client.xrange(RATING_STREAM_KEY, min='-', max='+', count=batch_size)
+
+    entry_ids = []
+    ratings = []
+    for entry_id, fields in entries:
+        entry_ids.append(entry_id)
+        try:
+            ratings.append((
+                int(fields[b'user_id']),
+                int(fields[b'package_id']),
+                int(fields[b'rating']),
+            ))
+        except (KeyError, ValueError) as e:
+            logger.error(f"Dropping malformed rating entry {entry_id}: {str(e)}")
+    return entry_ids, ratings
+
+
+def acknowledge_queued_ratings(entry_ids):
+    """Remove processed entries from the stream"""
+    if entry_ids:
+        _get_redis_client().xdel(RATING_STREAM_KEY, *entry_ids)
+
+
+def apply_ratings(ratings):
+    """
+    Fold a batch of ratings into PackageRating rows and the package aggregates.
+
+    Submissions are deduplicated per (user, package), keeping the latest one, and
+    each package is written once per batch.
+
+    Args:
+        ratings (list): (user_id, package_id, rating) tuples in submission order
+
+    Returns:
+        dict: package_id -> updated TripPackage, for packages that still exist
+    """
+    latest = {}
+    for user_id, package_id, rating in ratings:
+        latest[(user_id, package_id)] = rating
+
+    existing_users = set(
+        User.objects.filter(id__in={user_id for user_id, _ in latest}).values_list('id', flat=True)
+    )
+
+    by_package = defaultdict(dict)
+    for (user_id, package_id), rating in latest.items():
+        if user_id in existing_users:
+            by_package[package_id][user_id] = rating
+
+    updated_packages = {}
+    for package_id, user_ratings in by_package.items():
+        with transaction.atomic():
+            # Lock the package row so concurrent writers don't lose histogram updates
+            package = TripPackage.objects.select_for_update().filter(id=package_id).first()
+            if package is None:
+                continue
+
+            current_ratings = {
+                rating_obj.user_id: rating_obj
+                for rating_obj in PackageRating.objects.filter(package_id=package_id, user_id__in=user_ratings.keys())
+            }
+
+            to_create = []
+            to_update = []
+            for user_id, rating in user_ratings.items():
+                rating_obj = current_ratings.get(user_id)
+                if rating_obj is None:
+                    to_create.append(PackageRating(user_id=user_id, package_id=package_id, rating=rating))
+                    package.apply_rating(rating)
+                elif rating_obj.rating != rating:
+                    package.apply_rating(rating, old_rating=rating_obj.rating)
+                    rating_obj.rating = rating
+                    to_update.append(rating_obj)
+
+            if to_create:
+                PackageRating.objects.bulk_create(to_create)
+            if to_update:
+                PackageRating.objects.bulk_update(to_update, ['rating'])
+            if to_create or to_update:
+                package.save_rating_aggregates()
+
+        updated_packages[package_id] = package
+
+    if updated_packages:
+        invalidate_package_ratings(updated_packages.keys())
+
+    return updated_packages
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import TripPackage
+
+RATING_CACHE_FIELDS = ('id', 'rating', 'ratings_count', 'weighted_rating')
+
+
+def package_rating_cache_key(package_id):
+    return f"package_rating:{package_id}"
+
+
+def get_package_ratings(package_ids):
+    """
+    Get the rating summary of many packages, served from the per-package cache
+    where possible and with a single query for the misses.
+
+    Args:
+        package_ids (list): IDs of the packages
+
+    Returns:
+        dict: package_id -> {'package_id', 'rating', 'ratings_count', 'weighted_rating'}
+    """
+    keys = {package_rating_cache_key(package_id): package_id for package_id in package_ids}
+    cached = cache.get_many(keys.keys())
+    ratings = {keys[key]: value for key, value in cached.items()}
+
+    missing_ids = [package_id for package_id in package_ids if package_id not in ratings]
+    if missing_ids:
+        fetched = {}
+        for row in TripPackage.objects.filter(id__in=missing_ids).values(*RATING_CACHE_FIELDS):
+            fetched[row['id']] = {
+                'package_id': row['id'],
+                'rating': row['rating'],
+                'ratings_count': row['ratings_count'],
+                'weighted_rating': row['weighted_rating'],
+            }
+        if fetched:
+            cache.set_many(
+                {package_rating_cache_key(package_id): value for package_id, value in fetched.items()},
+                settings.CACHE_TTL
+            )
+        ratings.update(fetched)
+
+    return ratings
+
+
+def invalidate_package_ratings(package_ids):
+    cache.delete_many([package_rating_cache_key(package_id) for package_id in package_ids])
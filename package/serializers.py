@@ -1,13 +1,41 @@
 from rest_framework import serializers
 from .models import TripPackage
-from product.models import Product, Image
+from product.models import Product, Image, publish_packaged_recount
+from product.serializers import ImageIdListField, expand_image_fields
+from events.outbox import publish_cache_invalidation
+from utils.serializers import DynamicFieldsMixin
 
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ['id', 'name', 'summary', 'description', 'price', 'category']
 
-class TripPackageListSerializer(serializers.ModelSerializer):
+class ExpandableRelationsMixin:
+    """
+    A serializer mixin that takes an optional `expand` argument listing the
+    product relations to embed. The other relations are returned as IDs.
+    Without `expand` every relation is embedded.
+
+    `photos` is only rendered as image metadata when listed in `expand`, the
+    metadata has to be loaded in the context as `images` first.
+    """
+    expandable_fields = ('flight', 'hotel', 'activities')
+    expandable_image_fields = ('photos',)
+
+    def __init__(self, *args, **kwargs):
+        expand = kwargs.pop('expand', None)
+        super().__init__(*args, **kwargs)
+
+        if expand is not None:
+            for field_name in self.expandable_fields:
+                if field_name in self.fields and field_name not in expand:
+                    self.fields[field_name] = serializers.PrimaryKeyRelatedField(
+                        read_only=True, many=field_name == 'activities'
+                    )
+            expand_image_fields(self, self.expandable_image_fields, expand)
+
+class TripPackageListSerializer(ExpandableRelationsMixin, DynamicFieldsMixin, serializers.ModelSerializer):
+    photos = ImageIdListField(source='photo_ids', read_only=True)
     flight = ProductSerializer(read_only=True)
     hotel = ProductSerializer(read_only=True)
     activities = ProductSerializer(many=True, read_only=True)
@@ -17,10 +45,11 @@ class TripPackageListSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'photos', 'flight', 'hotel',
             'activities', 'price', 'start_date', 'end_date', 'published',
-            'available_units', 'rating', 'ratings_count'
+            'available_units', 'rating', 'ratings_count', 'weighted_rating'
         ]
 
 class TripPackageSerializer(serializers.ModelSerializer):
+    photos = ImageIdListField(source='photo_ids', required=False)
     flight = serializers.PrimaryKeyRelatedField(queryset=Product.objects.filter(category='flight'), required=False)
     hotel = serializers.PrimaryKeyRelatedField(queryset=Product.objects.filter(category='hotel'), required=False)
     activities = serializers.PrimaryKeyRelatedField(queryset=Product.objects.filter(category__in=['tourism', 'restaurant']), many=True, required=False)
@@ -55,6 +84,29 @@ class TripPackageSerializer(serializers.ModelSerializer):
         
         return super().to_internal_value(data)
 
+    def create(self, validated_data):
+        photo_ids = validated_data.pop('photo_ids', [])
+        # Read before super().create(), which pops the many-to-many fields
+        activity_ids = [activity.id for activity in validated_data.get('activities', [])]
+        instance = super().create(validated_data)
+        instance.set_photos(photo_ids)
+        # Activities are saved after the package row, so TripPackage.save() can't see them
+        publish_packaged_recount(activity_ids)
+        return instance
+
+    def update(self, instance, validated_data):
+        activities_changed = 'activities' in validated_data
+        old_activities = list(instance.activities.values_list('id', flat=True)) if activities_changed else []
+        photo_ids = validated_data.pop('photo_ids', None)
+        instance = super().update(instance, validated_data)
+        if photo_ids is not None:
+            instance.set_photos(photo_ids)
+        # Activities are saved after the package row, so TripPackage.save() can't see them change
+        if activities_changed:
+            publish_cache_invalidation('package', instance.id, related_models=['product'])
+            publish_packaged_recount(set(old_activities) | {activity.id for activity in validated_data['activities']})
+        return instance
+
     def validate(self, data):
         # Validate start_date is before end_date
         if data.get('start_date') and data.get('end_date'):
@@ -85,7 +137,8 @@ class TripPackageSerializer(serializers.ModelSerializer):
 
         return data
     
-class TripPackageDetailSerializer(serializers.ModelSerializer):
+class TripPackageDetailSerializer(ExpandableRelationsMixin, DynamicFieldsMixin, serializers.ModelSerializer):
+    photos = ImageIdListField(source='photo_ids', read_only=True)
     flight = ProductSerializer(read_only=True)
     hotel = ProductSerializer(read_only=True)
     activities = ProductSerializer(many=True, read_only=True)
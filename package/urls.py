@@ -1,7 +1,7 @@
 from django.urls import path
 from .views import (
     PackageCreateView, PackageListView, PackageDetailView, GenerateTransactionView, PurchasePackageView,
-    CancelTransactionView, RatePackageAPIView, GetPackageRatingAPIView,
+    CancelTransactionView, RatePackageAPIView, GetPackageRatingAPIView, BulkPackageRatingAPIView,
     UserPurchaseHistoryView
 )
 
@@ -15,4 +15,5 @@ urlpatterns = [
     path('customer/purchase-history/', UserPurchaseHistoryView.as_view(), name='user-purchase-history'),
     path('packages/<int:package_id>/rate/', RatePackageAPIView.as_view(), name='rate-package'),
     path('packages/<int:package_id>/rating/', GetPackageRatingAPIView.as_view(), name='get-package-rating'),
+    path('packages/ratings/', BulkPackageRatingAPIView.as_view(), name='bulk-package-ratings'),
 ]
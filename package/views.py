@@ -6,12 +6,15 @@ from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from rest_framework.pagination import PageNumberPagination
+from django.db import transaction as db_transaction
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
 from utils.cache_decorators import cache_view
 from utils.cache_monitoring import monitored_cache_view, MonitoredCacheMixin
-from .models import TripPackage, Transaction, PurchaseHistory, PackageRating
+from .models import TripPackage, Transaction, PurchaseHistory, UserPurchaseStats
+from .rating_buffer import apply_ratings, enqueue_rating, is_write_behind_enabled
+from .rating_cache import get_package_ratings
 from .serializers import TripPackageSerializer, TripPackageListSerializer, PurchasePackageSerializer, TripPackageDetailSerializer
 from authorization.permissions import IsPackageMaker, IsPackageMakerOrCustomer
 from datetime import datetime
@@ -20,7 +23,71 @@ from django.core.cache import cache
 from django.conf import settings
 from utils.cache_utils import invalidate_model_caches
 from rest_framework.decorators import api_view
-from django.db.models import Q
+from django.db.models import F, Q, Prefetch
+from product.models import Product
+from product.serializers import get_image_metadata
+from utils.serializers import parse_fields_param
+from .serializers import ProductSerializer as PackageProductSerializer
+
+def get_package_projection(request, serializer_class):
+    """
+    Read the `fields` and `expand` query parameters of a package endpoint.
+    Without `expand` every product relation is embedded, as before, and an
+    empty `expand=` embeds none. `photos` is only expanded when asked for.
+
+    Returns:
+        tuple: (fields, expand) lists of field names
+    """
+    fields = parse_fields_param(request, serializer_class.Meta.fields)
+    if request.query_params.get('expand') == '':
+        expand = []
+    else:
+        expand = parse_fields_param(
+            request, serializer_class.expandable_fields + serializer_class.expandable_image_fields,
+            default=serializer_class.expandable_fields, param='expand',
+        )
+    return fields, expand
+
+
+def get_photos_context(request, packages, fields, expand):
+    """
+    Serializer context with the metadata of all the packages' photos, loaded
+    at once, when `photos` is expanded.
+    """
+    if 'photos' not in fields or 'photos' not in expand:
+        return {}
+    return {'images': get_image_metadata(
+        (photo for package in packages for photo in package.photo_ids), request
+    )}
+
+
+def project_packages(queryset, fields, expand):
+    """
+    Limit a TripPackage queryset to the columns and relations the response needs:
+    expanded products are joined or prefetched, the others only load their IDs.
+    """
+    product_fields = PackageProductSerializer.Meta.fields
+    columns = ['id'] + [field for field in fields if field not in ('photos', 'flight', 'hotel', 'activities')]
+
+    if 'photos' in fields:
+        queryset = queryset.prefetch_related('photo_links')
+
+    for relation in ('flight', 'hotel'):
+        if relation not in fields:
+            continue
+        columns.append(relation)
+        if relation in expand:
+            queryset = queryset.select_related(relation)
+            columns.extend(f'{relation}__{field}' for field in product_fields)
+
+    if 'activities' in fields:
+        activity_fields = product_fields if 'activities' in expand else ['id']
+        queryset = queryset.prefetch_related(
+            Prefetch('activities', queryset=Product.all_objects.only(*activity_fields))
+        )
+
+    return queryset.only(*columns)
+
 
 class PackagePagination(PageNumberPagination):
     page_size = 10
@@ -67,7 +134,7 @@ class PackageListView(MonitoredCacheMixin, APIView):
         return f"{self.cache_key_prefix}:{request.path}:{params_str}"
     
     def get(self, request):
-        total_packages = TripPackage.objects.all().count()
+        fields, expand = get_package_projection(request, TripPackageListSerializer)
 
         # Get query parameters
         search = request.query_params.get('search')
@@ -80,7 +147,7 @@ class PackageListView(MonitoredCacheMixin, APIView):
         hotel_name = request.query_params.get('hotel_name')
         flight_airline = request.query_params.get('flight_airline')
 
-        queryset = TripPackage.objects.select_related('flight', 'hotel').prefetch_related('activities')
+        queryset = project_packages(TripPackage.objects.all(), fields, expand)
 
         if search:
             queryset = queryset.filter(name__icontains=search)
@@ -142,6 +209,8 @@ class PackageListView(MonitoredCacheMixin, APIView):
                 queryset = queryset.order_by('price')
             elif sort_by == 'date':
                 queryset = queryset.order_by('start_date')
+            elif sort_by == 'rating':
+                queryset = queryset.order_by('-weighted_rating', '-ratings_count')
 
         # Apply pagination
         paginator = self.pagination_class()
@@ -163,7 +232,10 @@ class PackageListView(MonitoredCacheMixin, APIView):
             )
 
         # Serialize the data
-        serializer = TripPackageListSerializer(paginated_queryset, many=True)
+        serializer = TripPackageListSerializer(
+            paginated_queryset, many=True, fields=fields, expand=expand,
+            context=get_photos_context(request, paginated_queryset, fields, expand),
+        )
 
         return Response(
             {
@@ -222,8 +294,12 @@ class PackageDetailView(MonitoredCacheMixin, APIView):
 
     def get(self, request, package_id):
         try:
-            package = TripPackage.objects.get(id=package_id)
-            serializer = TripPackageDetailSerializer(package)
+            fields, expand = get_package_projection(request, TripPackageDetailSerializer)
+            package = project_packages(TripPackage.objects.all(), fields, expand).get(id=package_id)
+            serializer = TripPackageDetailSerializer(
+                package, fields=fields, expand=expand,
+                context=get_photos_context(request, [package], fields, expand),
+            )
             return Response({
                 'status': 'success',
                 'message': 'Package details retrieved successfully',
@@ -381,6 +457,18 @@ class PurchasePackageView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
+            # Abandoned checkouts expire even if the expiry job hasn't cancelled them yet
+            if transaction.is_expired:
+                transaction.status = 'cancelled'
+                transaction.save(update_fields=['status'])
+                return Response(
+                    {
+                        'status': 'error',
+                        'message': 'Transaction has expired'
+                    },
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
             # Print request data for debugging
             print(f"Purchase request data: {request.data}")
 
@@ -399,27 +487,29 @@ class PurchasePackageView(APIView):
 
             card_number = serializer.validated_data['card_number']
 
-            # Mark the transaction as completed
-            transaction.status = 'completed'
-            transaction.purchase_date = timezone.now()
-            transaction.card_number = card_number[-4:]  # Store only the last 4 digits
-            transaction.save()
-
-            # Update available units
-            package = transaction.package
-            package.available_units -= transaction.quantity
-            package.save()
-
-            # Save purchase history
-            total_price = package.price * transaction.quantity
-            purchase_history = PurchaseHistory.objects.create(
-                user=request.user,
-                package=package,
-                transaction=transaction,
-                purchase_date=transaction.purchase_date,
-                quantity=transaction.quantity,
-                total_price=total_price
-            )
+            # Commit the purchase rows (and the events they publish) together
+            with db_transaction.atomic():
+                # Mark the transaction as completed
+                transaction.status = 'completed'
+                transaction.purchase_date = timezone.now()
+                transaction.card_number = card_number[-4:]  # Store only the last 4 digits
+                transaction.save()
+
+                # Update available units
+                package = transaction.package
+                package.available_units -= transaction.quantity
+                package.save()
+
+                # Save purchase history
+                total_price = package.price * transaction.quantity
+                purchase_history = PurchaseHistory.objects.create(
+                    user=request.user,
+                    package=package,
+                    transaction=transaction,
+                    purchase_date=transaction.purchase_date,
+                    quantity=transaction.quantity,
+                    total_price=total_price
+                )
 
             return Response(
                 {
@@ -481,41 +571,60 @@ class CancelTransactionView(APIView):
             status=status.HTTP_200_OK
         )
 
+class PurchaseHistoryPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'per_page'
+    max_page_size = 100
+    # Matches the (user, -purchase_date) index on PurchaseHistory
+    ordering = '-purchase_date'
+
 class UserPurchaseHistoryView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = PurchaseHistoryPagination
 
     def get(self, request):
-        # Retrieve the purchase history for the authenticated user
-        purchase_history = PurchaseHistory.objects.filter(user=request.user).select_related('package', 'transaction')
+        # Retrieve the purchase history for the authenticated user, fetching only the columns we return
+        purchase_history = PurchaseHistory.objects.filter(user=request.user).values(
+            'purchase_date', 'quantity', 'total_price',
+            package_name=F('package__name'),
+            transaction_code=F('transaction__transaction_id'),
+        )
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(purchase_history, request, view=self)
 
         # Serialize the data
         history_data = []
-        for purchase in purchase_history:
+        for purchase in page:
             history_data.append({
-                'package_name': purchase.package.name,
-                'purchase_date': purchase.purchase_date,
-                'quantity': purchase.quantity,
-                'total_price': purchase.total_price,
-                'transaction_id': purchase.transaction.transaction_id
+                'package_name': purchase['package_name'],
+                'purchase_date': purchase['purchase_date'],
+                'quantity': purchase['quantity'],
+                'total_price': purchase['total_price'],
+                'transaction_id': purchase['transaction_code']
             })
 
-        return Response(
-            {
-                'status': 'success',
-                'data': history_data
-            },
-            status=status.HTTP_200_OK
-        )
+        response_data = {
+            'status': 'success',
+            'data': history_data,
+            'next': paginator.get_next_link(),
+            'previous': paginator.get_previous_link(),
+        }
+
+        if request.query_params.get('include_totals', '').lower() == 'true':
+            stats = UserPurchaseStats.objects.filter(user=request.user).first()
+            response_data['totals'] = {
+                'total_spent': stats.total_spent if stats else 0,
+                'purchases_count': stats.purchases_count if stats else 0,
+                'units_count': stats.units_count if stats else 0,
+            }
+
+        return Response(response_data, status=status.HTTP_200_OK)
 
 class RatePackageAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, package_id, format=None):
-        try:
-            package = TripPackage.objects.get(id=package_id)
-        except TripPackage.DoesNotExist:
-            return Response({"error": "Package not found."}, status=status.HTTP_404_NOT_FOUND)
-
         rating = request.data.get('rating')
         try:
             rating = int(rating)
@@ -525,25 +634,29 @@ class RatePackageAPIView(APIView):
         if rating < 1 or rating > 5:
             return Response({"error": "Rating must be between 1 and 5."}, status=status.HTTP_400_BAD_REQUEST)
 
-        user = request.user
-        # Attempt to get an existing rating for this user and package.
-        rating_obj, created = PackageRating.objects.get_or_create(
-            user=user,
-            package=package,
-            defaults={'rating': rating}
-        )
-        if not created:
-            # If the rating exists, update it.
-            rating_obj.rating = rating
-            rating_obj.save()
+        if is_write_behind_enabled():
+            package = TripPackage.objects.filter(id=package_id).values('rating', 'ratings_count', 'weighted_rating').first()
+            if package is None:
+                return Response({"error": "Package not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        # Update the package's aggregate rating.
-        package.update_rating(rating)
+            enqueue_rating(request.user.id, package_id, rating)
+            return Response({
+                "message": "Rating accepted and will be applied shortly.",
+                "package_rating": package['rating'],
+                "ratings_count": package['ratings_count'],
+                "weighted_rating": package['weighted_rating'],
+            }, status=status.HTTP_202_ACCEPTED)
+
+        # Store the rating and update the package's aggregate rating.
+        package = apply_ratings([(request.user.id, package_id, rating)]).get(package_id)
+        if package is None:
+            return Response({"error": "Package not found."}, status=status.HTTP_404_NOT_FOUND)
 
         return Response({
             "message": "Rating submitted successfully.",
             "package_rating": package.rating,
             "ratings_count": package.ratings_count,
+            "weighted_rating": package.weighted_rating,
         }, status=status.HTTP_200_OK)
 
 
@@ -560,5 +673,36 @@ class GetPackageRatingAPIView(APIView):
             "package_id": package.id,
             "rating": package.rating,
             "ratings_count": package.ratings_count,
+            "weighted_rating": package.weighted_rating,
+            "histogram": package.rating_histogram,
         }
         return Response(data, status=status.HTTP_200_OK)
+
+
+class BulkPackageRatingAPIView(APIView):
+    """
+    Ratings of many packages in one request, e.g. for the cards of a list page.
+    Usage: GET packages/ratings/?ids=1,2,3
+    """
+    permission_classes = []
+    max_ids = 100
+
+    def get(self, request, format=None):
+        ids_param = request.query_params.get('ids', '')
+        try:
+            package_ids = list(dict.fromkeys(int(package_id) for package_id in ids_param.split(',') if package_id.strip()))
+        except ValueError:
+            return Response({"error": "ids must be a comma separated list of package IDs."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not package_ids:
+            return Response({"error": "At least one package ID is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(package_ids) > self.max_ids:
+            return Response({"error": f"At most {self.max_ids} package IDs can be requested at once."}, status=status.HTTP_400_BAD_REQUEST)
+
+        ratings = get_package_ratings(package_ids)
+
+        return Response({
+            "ratings": [ratings[package_id] for package_id in package_ids if package_id in ratings],
+            "not_found": [package_id for package_id in package_ids if package_id not in ratings],
+        }, status=status.HTTP_200_OK)
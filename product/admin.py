@@ -1,5 +1,10 @@
 from django.contrib import admin
-from .models import Product
+from .models import Product, ProductImage
+
+class ProductImageInline(admin.TabularInline):
+    model = ProductImage
+    raw_id_fields = ('image',)
+    extra = 0
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
@@ -8,3 +13,4 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ('name', 'summary', 'description')
     readonly_fields = ('created_at', 'updated_at')
     list_per_page = 25
+    inlines = [ProductImageInline]
@@ -0,0 +1,126 @@
+# Async versions of the image download and upload views, used instead of the
+# sync ones when IMAGE_ASYNC_VIEWS is set, for ASGI deployments. Blocking file
+# I/O runs in a bounded thread pool, so a slow client only holds a coroutine.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from utils.error_codes import ErrorCodes
+from utils.exceptions import ValidationError
+from .image_serving import serve_image
+from .image_variants import parse_variant_params, schedule_variants, select_variant
+from .imaging import hash_file, inspect_image
+from .models import Image
+from .upload_handlers import HashingMemoryFileUploadHandler, HashingTemporaryFileUploadHandler
+from .uploads import check_image_limits
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_io_executor = None
+
+
+def get_io_executor():
+    """The thread pool blocking file I/O of the async views runs in, created on first use"""
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_ASYNC_IO_WORKERS, thread_name_prefix='image-io',
+        )
+    return _io_executor
+
+
+async def run_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(get_io_executor(), func, *args)
+
+
+async def aiter_file(file, start, length):
+    """Stream `length` bytes of a file from `start`, reading in the I/O pool"""
+    try:
+        await run_io(file.seek, start)
+        while length > 0:
+            chunk = await run_io(file.read, min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await run_io(file.close)
+
+
+def _error(message, code, status_code):
+    return JsonResponse({'status': 'error', 'message': message, 'code': code}, status=status_code)
+
+
+class AsyncImageDownloadView(View):
+    """Async ImageDownloadView, the body is streamed by an async iterator"""
+
+    async def get(self, request, imageId, *args, **kwargs):
+        image = await Image.objects.filter(id=imageId).afirst()
+        if image is None:
+            return _error("Image not found.", ErrorCodes.NOT_FOUND, status.HTTP_404_NOT_FOUND)
+
+        versioned = bool(image.content_hash) and request.GET.get('v') == image.content_hash
+        try:
+            variant_params = parse_variant_params(request.GET)
+        except ValueError as e:
+            return _error(str(e), ErrorCodes.INVALID_INPUT, status.HTTP_400_BAD_REQUEST)
+
+        variant = None
+        if variant_params is not None:
+            variant = await sync_to_async(select_variant)(image, *variant_params)
+
+        # Builds the headers and opens the file, the body is read later by aiter_file
+        return await sync_to_async(serve_image)(
+            request, image, variant,
+            immutable=versioned and (variant_params is None or variant is not None),
+            stream_file=aiter_file,
+        )
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncImageUploadView(View):
+    """
+    Async ImageUploadView. The ASGI server has already received the body when
+    the view runs, parsing and hashing it run in the I/O pool.
+    """
+    async def post(self, request, *args, **kwargs):
+        try:
+            authenticated = await sync_to_async(JWTAuthentication().authenticate)(request)
+        except (AuthenticationFailed, InvalidToken) as e:
+            return _error(str(e.detail), ErrorCodes.INVALID_TOKEN, status.HTTP_401_UNAUTHORIZED)
+        if authenticated is None:
+            return _error("Authentication credentials were not provided.", ErrorCodes.INVALID_TOKEN, status.HTTP_401_UNAUTHORIZED)
+
+        request.upload_handlers = [HashingMemoryFileUploadHandler(request), HashingTemporaryFileUploadHandler(request)]
+        files = await run_io(lambda: request.FILES)
+        file = files.get('file')
+        if not file:
+            return _error("No file provided.", ErrorCodes.INVALID_INPUT, status.HTTP_400_BAD_REQUEST)
+
+        content_hash = getattr(file, 'content_hash', None) or await run_io(hash_file, file)
+        content_type, width, height = await run_io(inspect_image, file, file.name)
+        try:
+            check_image_limits(content_type, width, height, file.size)
+        except ValidationError as e:
+            return _error(str(e.detail), ErrorCodes.INVALID_INPUT, status.HTTP_400_BAD_REQUEST)
+
+        image, created = await sync_to_async(Image.store)(
+            file, content_hash, authenticated[0], content_type=content_type, width=width, height=height,
+        )
+        if created:
+            await sync_to_async(schedule_variants)(image)
+
+        return JsonResponse({
+            'status': 'success',
+            'message': 'Here is your image :)',
+            'imageId': image.id,
+        }, status=status.HTTP_200_OK)
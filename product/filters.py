@@ -4,8 +4,16 @@ from .models import Product
 class ProductFilter(filters.FilterSet):
     minPrice = filters.NumberFilter(field_name='price', lookup_expr='gte')
     maxPrice = filters.NumberFilter(field_name='price', lookup_expr='lte')
+    # Price after discount, served from the effective_price index
+    minEffectivePrice = filters.NumberFilter(field_name='effective_price', lookup_expr='gte')
+    maxEffectivePrice = filters.NumberFilter(field_name='effective_price', lookup_expr='lte')
     category = filters.ChoiceFilter(choices=Product.CATEGORY_CHOICES)
     stockAvailable = filters.BooleanFilter(method='filter_stock_available')
+    ordering = filters.OrderingFilter(fields=(
+        ('effective_price', 'effectivePrice'),
+        ('price', 'price'),
+        ('created_at', 'createdAt'),
+    ))
     
     class Meta:
         model = Product
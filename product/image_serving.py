@@ -0,0 +1,195 @@
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .image_variants import variant_content_type
+from .imaging import hash_file, inspect_image
+
+RANGE_CHUNK_SIZE = 64 * 1024
+# One year, the longest max-age caches are expected to honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_byte_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_content_type(image):
+    """
+    The stored content type of an image. Images uploaded before it was stored
+    are detected once here and saved.
+    """
+    if not image.content_type:
+        with image.file.open('rb') as file:
+            image.content_type, image.width, image.height = inspect_image(file, image.file.name)
+        image.save(update_fields=['content_type', 'width', 'height'])
+    return image.content_type
+
+
+def get_content_hash(obj):
+    """
+    The stored content hash of an Image or ImageVariant. Files stored before
+    it was computed are hashed once here and saved.
+    """
+    if not obj.content_hash:
+        with obj.file.open('rb') as file:
+            obj.content_hash = hash_file(file)
+        obj.save(update_fields=['content_hash'])
+    return obj.content_hash
+
+
+def _local_path(file):
+    try:
+        return file.path
+    except NotImplementedError:
+        # Storage without local files
+        return None
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header holding a single byte range.
+
+    Args:
+        header (str): The Range header
+        size (int): Size of the file
+
+    Returns:
+        tuple: (start, end) with end inclusive, None if the header should be
+            ignored (invalid or several ranges), or False if it can't be satisfied
+    """
+    match = _byte_range_re.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+
+    if first == '':
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    end = int(last) if last else size - 1
+    return start, min(end, size - 1)
+
+
+def _iter_range(file, start, length):
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def _set_cache_headers(response, etag, last_modified, immutable):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if immutable:
+        response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response['Cache-Control'] = f'public, max-age={settings.IMAGE_CACHE_MAX_AGE}'
+    return response
+
+
+def serve_image(request, image, variant=None, immutable=False, stream_file=None):
+    """
+    Build the response for downloading an image, or one of its variants,
+    according to IMAGE_SERVE_MODE:
+
+    - 'x-accel-redirect': nginx serves the file from the internal location
+      IMAGE_ACCEL_REDIRECT_PREFIX + file name
+    - 'x-sendfile': Apache (mod_xsendfile) or lighttpd serves the file by path
+    - 'redirect': the client is redirected to the storage URL, presigned for
+      S3, so the bytes don't go through the app at all
+    - 'django': the file is streamed by Django. A real OS file is passed to
+      FileResponse so WSGI servers with wsgi.file_wrapper can use sendfile()
+
+    The content hash is sent as a strong ETag with the upload time as
+    Last-Modified, and conditional requests are answered with 304 before the
+    file is touched. In 'django' mode a single byte range is served with 206,
+    the front proxy handles ranges in the other modes.
+
+    Args:
+        request: The request, for the conditional and Range headers
+        image (Image): The image to serve
+        variant (ImageVariant, optional): Serve this variant instead of the original
+        immutable (bool): The URL is content addressed, let caches keep the response for good
+        stream_file (callable, optional): stream_file(file, start, length) returning the
+            iterator the body is streamed from in 'django' mode, e.g. an async one under ASGI
+
+    Returns:
+        HttpResponse
+    """
+    if variant is not None:
+        file_field, content_type = variant.file, variant_content_type(variant)
+        last_modified = variant.created_at
+    else:
+        file_field, content_type = image.file, get_content_type(image)
+        last_modified = image.uploaded_at
+    etag = f'"{get_content_hash(variant or image)}"'
+    last_modified = int(last_modified.timestamp())
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return _set_cache_headers(not_modified, etag, last_modified, immutable)
+
+    mode = settings.IMAGE_SERVE_MODE
+
+    if mode == 'redirect':
+        # Presigned URLs expire, so the redirect itself is only cached briefly
+        response = HttpResponseRedirect(file_field.storage.url(file_field.name))
+        response['Cache-Control'] = f'private, max-age={settings.IMAGE_STORAGE_URL_EXPIRY // 2}'
+        return response
+
+    if mode == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.IMAGE_ACCEL_REDIRECT_PREFIX + quote(file_field.name)
+        return _set_cache_headers(response, etag, last_modified, immutable)
+
+    path = _local_path(file_field)
+    if mode == 'x-sendfile' and path:
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return _set_cache_headers(response, etag, last_modified, immutable)
+
+    size = os.path.getsize(path) if path else file_field.size
+    byte_range = None
+    range_header = request.headers.get('Range')
+    # If-Range: only send a part if the client's copy is still current
+    if range_header and request.headers.get('If-Range', etag) == etag:
+        byte_range = parse_range(range_header, size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    file = open(path, 'rb') if path else file_field.open('rb')
+    if byte_range is None and stream_file is not None:
+        response = StreamingHttpResponse(stream_file(file, 0, size), content_type=content_type)
+        response['Content-Length'] = str(size)
+    elif byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            (stream_file or _iter_range)(file, start, end - start + 1), status=206, content_type=content_type,
+        )
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return _set_cache_headers(response, etag, last_modified, immutable)
@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+
+from .imaging import VARIANT_CONTENT_TYPES, render_variants, supported_variant_formats
+from .models import Image, ImageVariant
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def get_executor():
+    """The process pool rendering variants, created on first use"""
+    global _executor
+    if _executor is None:
+        # spawn instead of fork: the workers only need product.imaging, not a copy of Django's state
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.IMAGE_VARIANT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _executor
+
+
+def get_render_args(image):
+    """Arguments of imaging.render_variants for an image"""
+    with image.file.open('rb') as file:
+        source = file.read()
+    return (
+        source,
+        settings.IMAGE_VARIANT_WIDTHS,
+        supported_variant_formats(settings.IMAGE_VARIANT_FORMATS),
+        settings.IMAGE_VARIANT_QUALITY,
+    )
+
+
+def save_variants(image_id, variants):
+    """
+    Store rendered variants next to the original, replacing existing ones with
+    the same width and format.
+
+    Args:
+        image_id (int): ID of the Image
+        variants (list): (width, height, format, bytes) tuples from imaging.render_variants
+
+    Returns:
+        list: The saved ImageVariant objects, empty if the image was deleted meanwhile
+    """
+    image = Image.objects.filter(id=image_id).first()
+    if image is None:
+        return []
+
+    existing = {(variant.width, variant.format): variant for variant in image.variants.all()}
+    saved = []
+    for width, height, fmt, data in variants:
+        variant = existing.get((width, fmt))
+        if variant is not None:
+            variant.file.delete(save=False)
+        else:
+            variant = ImageVariant(image=image, width=width, format=fmt)
+        variant.height = height
+        variant.size = len(data)
+        variant.content_hash = hashlib.sha256(data).hexdigest()
+        variant.file.save(f"{width}.{fmt}", ContentFile(data), save=False)
+        variant.save()
+        saved.append(variant)
+    return saved
+
+
+def generate_variants(image):
+    """Render and store the variants of an image in the current process"""
+    return save_variants(image.id, render_variants(*get_render_args(image)))
+
+
+def _store_rendered(image_id, future):
+    # Runs in the executor's callback thread, which has its own DB connection
+    try:
+        save_variants(image_id, future.result())
+    except Exception as e:
+        logger.error(f"Failed to generate variants of image {image_id}: {str(e)}")
+    finally:
+        connections.close_all()
+
+
+def schedule_variants(image):
+    """
+    Generate the variants of a new image off the request path, once the
+    current transaction has committed. With IMAGE_VARIANT_WORKERS = 0 they are
+    rendered in-process instead.
+    """
+    # Files Pillow can't read have no size and no variants
+    if not settings.IMAGE_VARIANT_WIDTHS or image.width is None:
+        return
+
+    def submit():
+        if settings.IMAGE_VARIANT_WORKERS <= 0:
+            try:
+                generate_variants(image)
+            except Exception as e:
+                logger.error(f"Failed to generate variants of image {image.id}: {str(e)}")
+            return
+        future = get_executor().submit(render_variants, *get_render_args(image))
+        future.add_done_callback(lambda done: _store_rendered(image.id, done))
+
+    transaction.on_commit(submit)
+
+
+def select_variant(image, width, fmt):
+    """
+    Pick the variant to serve for a requested width: the smallest one at least
+    that wide, or the largest one if none is.
+
+    Returns:
+        ImageVariant or None if the image has no variant in that format
+    """
+    variants = image.variants.filter(format=fmt)
+    return (
+        variants.filter(width__gte=width).order_by('width').first()
+        or variants.order_by('-width').first()
+    )
+
+
+def parse_variant_params(params):
+    """
+    Read the `w` and `fmt` download parameters.
+
+    Returns:
+        tuple: (width, format), or None if no variant is asked for
+
+    Raises:
+        ValueError: If they are invalid
+    """
+    width = params.get('w')
+    if width is None:
+        return None
+    fmt = params.get('fmt', settings.IMAGE_VARIANT_FORMATS[0])
+    if not width.isdigit() or int(width) <= 0 or fmt not in VARIANT_CONTENT_TYPES:
+        raise ValueError("w must be a positive integer and fmt one of " + ", ".join(VARIANT_CONTENT_TYPES))
+    return int(width), fmt
+
+
+def variant_content_type(variant):
+    return VARIANT_CONTENT_TYPES.get(variant.format, 'application/octet-stream')
@@ -0,0 +1,107 @@
+# Image helpers that only depend on Pillow, so they can also run in worker processes
+import hashlib
+import io
+import mimetypes
+
+from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+HASH_CHUNK_SIZE = 64 * 1024
+
+VARIANT_CONTENT_TYPES = {
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+}
+
+
+def inspect_image(file, name=None):
+    """
+    Detect the MIME type and size of an image from its content. The type falls
+    back to the file name when the content isn't a known image.
+
+    Args:
+        file: A file-like object opened in binary mode; its position is restored
+        name (str, optional): The file name
+
+    Returns:
+        tuple: (content_type, width, height), width and height are None if unknown
+    """
+    position = file.tell() if hasattr(file, 'tell') else None
+    content_type, width, height = None, None, None
+    try:
+        with PILImage.open(file) as img:
+            content_type = PILImage.MIME.get(img.format)
+            width, height = img.size
+    except (UnidentifiedImageError, OSError, ValueError):
+        pass
+    finally:
+        if position is not None:
+            file.seek(position)
+
+    if content_type is None and name:
+        content_type, _ = mimetypes.guess_type(name)
+    return content_type or DEFAULT_CONTENT_TYPE, width, height
+
+
+def hash_file(file):
+    """
+    SHA-256 hex digest of a file's content, read in chunks.
+
+    Args:
+        file: A file-like object opened in binary mode; its position is restored
+
+    Returns:
+        str: The hex digest
+    """
+    position = file.tell() if hasattr(file, 'tell') else None
+    digest = hashlib.sha256()
+    try:
+        if position is not None:
+            file.seek(0)
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    finally:
+        if position is not None:
+            file.seek(position)
+    return digest.hexdigest()
+
+
+def supported_variant_formats(formats):
+    """The formats of `formats` this Pillow build can encode (AVIF needs a plugin)"""
+    # Loads all plugins, PILImage.SAVE is only filled in lazily
+    PILImage.init()
+    return [fmt for fmt in formats if fmt.upper() in PILImage.SAVE]
+
+
+def render_variants(source, widths, formats, quality=80):
+    """
+    Resize an image to each width (never upscaling) and encode it in each format.
+
+    Args:
+        source (bytes): The original image
+        widths (list): Target widths in pixels
+        formats (list): Format names, e.g. ['webp', 'avif']
+        quality (int): Encoder quality
+
+    Returns:
+        list: (width, height, format, bytes) tuples
+    """
+    variants = []
+    with PILImage.open(io.BytesIO(source)) as original:
+        # Apply the EXIF orientation, variants are stored without metadata
+        img = ImageOps.exif_transpose(original)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+
+        targets = sorted({min(width, img.width) for width in widths})
+        for width in targets:
+            height = max(1, round(img.height * width / img.width))
+            resized = img if width == img.width else img.resize((width, height), PILImage.LANCZOS)
+            for fmt in formats:
+                frame = resized.convert('RGB') if fmt == 'jpeg' and resized.mode == 'RGBA' else resized
+                output = io.BytesIO()
+                frame.save(output, format=fmt.upper(), quality=quality)
+                variants.append((width, height, fmt, output.getvalue()))
+    return variants
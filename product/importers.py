@@ -0,0 +1,305 @@
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+
+from events.outbox import publish_cache_invalidation
+from .models import Image, Product, ProductImage, publish_provider_stats
+
+CATEGORIES = {choice for choice, _ in Product.CATEGORY_CHOICES}
+REQUIRED_FIELDS = ('name', 'summary', 'description', 'price', 'stock', 'category')
+MAX_ERRORS_REPORTED = 100
+
+
+def iter_jsonl_rows(lines):
+    """
+    Parse JSON Lines, one product object per line.
+
+    Yields:
+        tuple: (row number, dict) or (row number, None) for unparsable lines
+    """
+    row_number = 0
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        row_number += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row_number, row if isinstance(row, dict) else None
+
+
+def iter_csv_rows(lines):
+    """
+    Parse CSV with a header line. Empty cells are treated as missing values.
+
+    Yields:
+        tuple: (row number, dict)
+    """
+    decoded = (line.decode('utf-8') if isinstance(line, bytes) else line for line in lines)
+    for row_number, row in enumerate(csv.DictReader(decoded), start=1):
+        yield row_number, {key: value for key, value in row.items() if key and value not in ('', None)}
+
+
+def _parse_decimal(value, max_digits, decimal_places):
+    value = Decimal(str(value))
+    if not value.is_finite():
+        raise InvalidOperation
+    value = value.quantize(Decimal(1).scaleb(-decimal_places))
+    if len(value.as_tuple().digits) > max_digits:
+        raise InvalidOperation
+    return value
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', '1', 'yes'):
+        return True
+    if str(value).lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError
+
+
+def _parse_images(value):
+    if isinstance(value, str):
+        value = value.strip()
+        # CSV cells may hold a JSON list or pipe separated IDs
+        value = json.loads(value) if value.startswith('[') else [part for part in value.split('|') if part]
+    if not isinstance(value, list):
+        raise ValueError
+    return [int(image_id) for image_id in value]
+
+
+def _clean_row(row, is_update):
+    """
+    Convert a raw row to model field values.
+
+    Returns:
+        tuple: (cleaned dict, errors dict)
+    """
+    cleaned = {}
+    errors = {}
+
+    if not is_update:
+        for field in REQUIRED_FIELDS:
+            if row.get(field) in (None, ''):
+                errors[field] = 'This field is required.'
+
+    for field, max_length in (('name', 255), ('summary', 500), ('description', None)):
+        if field in row and field not in errors:
+            value = str(row[field])
+            if max_length and len(value) > max_length:
+                errors[field] = f'Ensure this field has no more than {max_length} characters.'
+            else:
+                cleaned[field] = value
+
+    for field, max_digits in (('price', 10), ('discount', 5)):
+        if row.get(field) not in (None, '') and field not in errors:
+            try:
+                cleaned[field] = _parse_decimal(row[field], max_digits, 2)
+                if cleaned[field] < 0:
+                    errors[field] = 'Ensure this value is greater than or equal to 0.'
+            except (InvalidOperation, ValueError, TypeError):
+                errors[field] = 'A valid number is required.'
+
+    if row.get('stock') not in (None, '') and 'stock' not in errors:
+        try:
+            cleaned['stock'] = int(row['stock'])
+            if cleaned['stock'] < 0:
+                errors['stock'] = 'Ensure this value is greater than or equal to 0.'
+        except (ValueError, TypeError):
+            errors['stock'] = 'A valid integer is required.'
+
+    if row.get('category') not in (None, '') and 'category' not in errors:
+        if row['category'] in CATEGORIES:
+            cleaned['category'] = row['category']
+        else:
+            errors['category'] = f'"{row["category"]}" is not a valid choice.'
+
+    if 'images' in row:
+        try:
+            cleaned['images'] = _parse_images(row['images'])
+        except (ValueError, TypeError):
+            errors['images'] = 'A list of image IDs is required.'
+
+    if 'isActive' in row:
+        try:
+            cleaned['isActive'] = _parse_bool(row['isActive'])
+        except ValueError:
+            errors['isActive'] = 'Must be a valid boolean.'
+
+    return cleaned, errors
+
+
+def validate_batch(provider, rows):
+    """
+    Validate a batch of raw rows. Ownership of the products being updated is
+    checked with a single query for the whole batch.
+
+    Args:
+        provider (ProviderProfile): The provider importing the products
+        rows (list): (row number, raw dict or None) tuples
+
+    Returns:
+        tuple: (list of (row number, product id or None, cleaned dict), list of errors)
+    """
+    valid = []
+    errors = []
+
+    update_ids = set()
+    for _, row in rows:
+        if row and row.get('id') not in (None, ''):
+            try:
+                update_ids.add(int(row['id']))
+            except (ValueError, TypeError):
+                pass
+    owned_ids = set(
+        Product.objects.filter(id__in=update_ids, provider=provider).values_list('id', flat=True)
+    ) if update_ids else set()
+
+    for row_number, row in rows:
+        if row is None:
+            errors.append({'row': row_number, 'errors': {'error': 'Row is not a valid product object.'}})
+            continue
+
+        product_id = None
+        if row.get('id') not in (None, ''):
+            try:
+                product_id = int(row['id'])
+            except (ValueError, TypeError):
+                errors.append({'row': row_number, 'errors': {'id': 'A valid integer is required.'}})
+                continue
+            if product_id not in owned_ids:
+                errors.append({'row': row_number, 'errors': {'id': 'Product not found or you do not have permission to update it.'}})
+                continue
+
+        cleaned, row_errors = _clean_row(row, is_update=product_id is not None)
+        if row_errors:
+            errors.append({'row': row_number, 'errors': row_errors})
+        else:
+            valid.append((row_number, product_id, cleaned))
+
+    # Image IDs are checked with a single query for the whole batch as well
+    image_ids = {image_id for _, _, cleaned in valid for image_id in cleaned.get('images', ())}
+    existing_ids = set(
+        Image.objects.filter(id__in=image_ids).values_list('id', flat=True)
+    ) if image_ids else set()
+    checked = []
+    for row_number, product_id, cleaned in valid:
+        unknown = [str(image_id) for image_id in cleaned.get('images', ()) if image_id not in existing_ids]
+        if unknown:
+            errors.append({'row': row_number, 'errors': {'images': f"Unknown image IDs: {', '.join(unknown)}"}})
+        else:
+            checked.append((row_number, product_id, cleaned))
+    errors.sort(key=lambda error: error['row'])
+
+    return checked, errors
+
+
+def _write_image_links(images):
+    """Replace the images of many products, given as (product, image IDs) pairs"""
+    ProductImage.objects.filter(product__in=[product for product, _ in images]).delete()
+    ProductImage.objects.bulk_create([
+        ProductImage(product=product, image_id=image_id, position=position)
+        for product, image_ids in images
+        for position, image_id in enumerate(image_ids)
+    ], batch_size=1000)
+
+
+def import_products(provider, rows, chunk_size=1000, max_rows=None):
+    """
+    Create or update products from parsed rows in chunks, with bulk_create and
+    bulk_update, and a single cache invalidation at the end.
+
+    Rows with an `id` update that product (only the given fields), the others
+    create new products. Invalid rows are skipped and reported.
+
+    Args:
+        provider (ProviderProfile): The provider importing the products
+        rows (iterable): (row number, raw dict) tuples, e.g. from iter_jsonl_rows
+        chunk_size (int): Number of rows validated and written per batch
+        max_rows (int, optional): Stop with an error after this many rows
+
+    Returns:
+        dict: created, updated and failed counts and the reported errors
+    """
+    result = {'created': 0, 'updated': 0, 'failed': 0, 'errors': []}
+    rows = iter(rows)
+    total_rows = 0
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        total_rows += len(chunk)
+        if max_rows is not None and total_rows > max_rows:
+            result['errors'].append({'row': None, 'errors': {'error': f'Imports are limited to {max_rows} rows.'}})
+            break
+
+        valid, errors = validate_batch(provider, chunk)
+
+        # Images are written to ProductImage once the products have IDs
+        images = []
+        to_create = []
+        for _, product_id, cleaned in valid:
+            if product_id is None:
+                image_ids = cleaned.pop('images', None)
+                to_create.append(Product(provider=provider, **cleaned))
+                if image_ids:
+                    images.append((to_create[-1], image_ids))
+        updates = {product_id: (row_number, cleaned) for row_number, product_id, cleaned in valid if product_id is not None}
+
+        with transaction.atomic():
+            stats_deltas = []
+            stats_recount = []
+            if to_create:
+                stats_deltas.extend(product.provider_stats_changes()[0][0] for product in to_create)
+                Product.objects.bulk_create(to_create)
+                result['created'] += len(to_create)
+
+            if updates:
+                # Locked, the products were validated outside the transaction and
+                # may have been deleted since
+                products = Product.objects.select_for_update().filter(provider=provider).in_bulk(updates.keys())
+                update_fields = {'updated_at'}
+                now = timezone.now()
+                for product_id, (row_number, cleaned) in updates.items():
+                    if product_id not in products:
+                        errors.append({'row': row_number, 'errors': {'id': 'Product not found or you do not have permission to update it.'}})
+                        continue
+                    if 'images' in cleaned:
+                        images.append((products[product_id], cleaned.pop('images')))
+                    for field, value in cleaned.items():
+                        setattr(products[product_id], field, value)
+                    # bulk_update doesn't apply auto_now
+                    products[product_id].updated_at = now
+                    update_fields.update(cleaned.keys())
+                    deltas, recount = products[product_id].provider_stats_changes()
+                    stats_deltas.extend(deltas)
+                    stats_recount.extend(recount)
+                if products:
+                    Product.objects.bulk_update(list(products.values()), list(update_fields))
+                result['updated'] += len(products)
+
+            if images:
+                _write_image_links(images)
+
+            publish_provider_stats(deltas=stats_deltas, recount=stats_recount)
+
+        errors.sort(key=lambda error: error['row'])
+        result['failed'] += len(errors)
+        result['errors'].extend(errors[:MAX_ERRORS_REPORTED - len(result['errors'])])
+
+    if result['created'] or result['updated']:
+        publish_cache_invalidation('product', related_models=['package'])
+
+    return result
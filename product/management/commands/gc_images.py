@@ -0,0 +1,108 @@
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from package.models import PackagePhoto
+from product.models import Image, ImageUpload, ProductImage
+from product.uploads import abort_upload
+from utils.storage import get_image_storage
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete images no product or trip package refers to and that have not been uploaded '
+        'for IMAGE_GC_GRACE, in small batches, and expired upload sessions.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-days', type=float, default=None,
+                            help='Override IMAGE_GC_GRACE.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of images deleted per transaction.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count what would be deleted.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, repeating every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=3600.0,
+                            help='Seconds between runs with --loop.')
+
+    def handle(self, *args, **options):
+        grace = settings.IMAGE_GC_GRACE
+        if options['grace_days'] is not None:
+            grace = timedelta(days=options['grace_days'])
+        self.dry_run = options['dry_run']
+        verb = 'Would delete' if self.dry_run else 'Deleted'
+
+        while True:
+            deleted = self.collect(timezone.now() - grace, options['batch_size'])
+            uploads = self.clean_uploads()
+            self.stdout.write(f"{verb} {deleted} images and {uploads} expired uploads")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def collect(self, cutoff, batch_size):
+        # Both lookups are index scans of the image_id columns of the link tables.
+        # Soft deleted products keep their links, and images, until they are purged
+        unreferenced = (
+            Image.objects
+            .filter(referenced_at__lt=cutoff)
+            .exclude(Exists(ProductImage.objects.filter(image=OuterRef('pk'))))
+            .exclude(Exists(PackagePhoto.objects.filter(image=OuterRef('pk'))))
+        )
+
+        total = 0
+        last_id = 0
+        while True:
+            ids = list(
+                unreferenced.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            if self.dry_run:
+                total += len(ids)
+                continue
+            # Short transactions. Checked again under the lock, so an image referenced
+            # or uploaded again meanwhile is kept
+            with transaction.atomic():
+                ids = list(unreferenced.select_for_update().filter(id__in=ids).values_list('id', flat=True))
+                total += Image.purge(ids)
+        return total
+
+    def clean_uploads(self):
+        expired = ImageUpload.objects.filter(updated_at__lt=timezone.now() - settings.IMAGE_UPLOAD_EXPIRY)
+        total = 0
+        storage = get_image_storage()
+        for upload in expired.iterator():
+            total += 1
+            if self.dry_run:
+                continue
+            # A direct upload may have reached the storage without being completed
+            if upload.storage_name and not Image.objects.filter(file=upload.storage_name).exists():
+                storage.delete(upload.storage_name)
+            abort_upload(upload)
+
+        if not self.dry_run:
+            self.clean_temp_dir()
+        return total
+
+    def clean_temp_dir(self):
+        # Received bytes left behind by a crash between deleting an upload and its file
+        try:
+            names = os.listdir(settings.IMAGE_UPLOAD_TEMP_DIR)
+        except FileNotFoundError:
+            return
+        live = {str(upload_id) for upload_id in ImageUpload.objects.values_list('id', flat=True)}
+        cutoff = time.time() - settings.IMAGE_UPLOAD_EXPIRY.total_seconds()
+        for name in names:
+            path = os.path.join(settings.IMAGE_UPLOAD_TEMP_DIR, name)
+            if name not in live and os.path.getmtime(path) < cutoff:
+                os.remove(path)
@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Case, Count, ExpressionWrapper, F, IntegerField, Q, Value, When
+
+from product.image_variants import get_executor, get_render_args, save_variants
+from product.imaging import render_variants, supported_variant_formats
+from product.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Generate the resized variants of images, in batches, using the IMAGE_VARIANT_WORKERS process pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Number of images rendered concurrently per batch.')
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate variants of every image, not only images missing some.')
+
+    def handle(self, *args, **options):
+        images = Image.objects.order_by('id')
+        if not options['all']:
+            images = self.missing_variants(images)
+
+        batch_size = options['batch_size']
+        total = 0
+        last_id = 0
+        while True:
+            batch = list(images.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            jobs = []
+            for image in batch:
+                try:
+                    jobs.append((image, get_render_args(image)))
+                except OSError as e:
+                    self.stderr.write(f"Skipping image {image.id}: {str(e)}")
+
+            executor = get_executor() if settings.IMAGE_VARIANT_WORKERS > 0 else None
+            if executor is not None:
+                jobs = [(image, executor.submit(render_variants, *args)) for image, args in jobs]
+
+            for image, job in jobs:
+                # One corrupt image is skipped, not the rest of the run
+                try:
+                    variants = job.result() if executor is not None else render_variants(*job)
+                except Exception as e:
+                    self.stderr.write(f"Skipping image {image.id}: {str(e)}")
+                    continue
+                save_variants(image.id, variants)
+                total += 1
+
+            self.stdout.write(f"Generated variants for {total} images")
+
+    def missing_variants(self, images):
+        """Images with fewer variants than render_variants makes of them, selected in SQL"""
+        widths = sorted(set(settings.IMAGE_VARIANT_WIDTHS))
+        formats = supported_variant_formats(settings.IMAGE_VARIANT_FORMATS)
+        if not widths or not formats:
+            return images.none()
+
+        # render_variants never upscales: widths over the image's are rendered once, at its width
+        per_format = sum(
+            (Case(When(width__gt=width, then=Value(1)), default=Value(0)) for width in widths),
+            Case(When(width__lte=widths[-1], then=Value(1)), default=Value(0)),
+        )
+        return (
+            images.filter(width__isnull=False)
+            .annotate(
+                variant_count=Count('variants', filter=Q(variants__format__in=formats)),
+                expected_count=ExpressionWrapper(per_format * len(formats), output_field=IntegerField()),
+            )
+            .filter(variant_count__lt=F('expected_count'))
+        )
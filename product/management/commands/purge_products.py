@@ -0,0 +1,65 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from events.outbox import publish_cache_invalidation
+from product.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Hard delete products soft deleted more than PRODUCT_PURGE_AFTER ago, in small batches. '
+        'Products still used by trip packages are kept.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-days', type=int, default=None,
+                            help='Override PRODUCT_PURGE_AFTER.')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Number of products deleted per transaction.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, repeating every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=300.0,
+                            help='Seconds between runs with --loop.')
+
+    def handle(self, *args, **options):
+        grace = settings.PRODUCT_PURGE_AFTER
+        if options['grace_days'] is not None:
+            grace = timedelta(days=options['grace_days'])
+
+        while True:
+            purged = self.purge(timezone.now() - grace, options['batch_size'])
+            self.stdout.write(f"Purged {purged} products")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def purge(self, cutoff, batch_size):
+        total = 0
+        while True:
+            # Short transactions so the write lock is released between batches
+            with transaction.atomic():
+                ids = list(
+                    Product.all_objects
+                    .filter(
+                        deleted_at__lt=cutoff,
+                        flight_packages__isnull=True,
+                        hotel_packages__isnull=True,
+                        activity_packages__isnull=True,
+                    )
+                    .values_list('id', flat=True)[:batch_size]
+                )
+                if not ids:
+                    break
+                Product.all_objects.filter(id__in=ids).delete()
+            total += len(ids)
+
+        # Tombstoned products are already hidden, this only drops stale entries
+        if total:
+            publish_cache_invalidation('product', related_models=['package'])
+        return total
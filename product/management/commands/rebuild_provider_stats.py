@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from product.models import ProviderStats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the ProviderStats dashboard summaries from the products.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--provider', type=int, action='append', dest='provider_ids',
+                            help='Only rebuild this provider profile ID (can be repeated).')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = ProviderStats.rebuild(options['provider_ids'])
+        self.stdout.write(f"Rebuilt {count} provider summaries")
@@ -0,0 +1,54 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_provider_stats(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    ProviderStats = apps.get_model('product', 'ProviderStats')
+    TripPackage = apps.get_model('package', 'TripPackage')
+
+    in_package = Q(Exists(TripPackage.objects.filter(Q(flight=OuterRef('pk')) | Q(hotel=OuterRef('pk'))))) \
+        | Q(Exists(TripPackage.activities.through.objects.filter(product=OuterRef('pk'))))
+    summaries = Product.objects.filter(deleted_at__isnull=True).order_by().values('provider_id', 'category').annotate(
+        products_count=Count('id'),
+        active_count=Count('id', filter=Q(isActive=True)),
+        stock_total=Coalesce(Sum('stock'), 0),
+        packaged_count=Count('id', filter=in_package),
+    )
+    ProviderStats.objects.bulk_create(
+        [ProviderStats(**summary) for summary in summaries],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authorization', '0002_alter_baseuser_role'),
+        ('product', '0004_product_deleted_at'),
+        ('package', '0008_transaction_expiry_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProviderStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('flight', 'Flight Ticket'), ('train', 'Train Ticket'), ('bus', 'Bus Ticket'), ('hotel', 'Hotel'), ('tourism', 'Tourism Ticket'), ('restaurant', 'Restaurant')], max_length=100)),
+                ('products_count', models.IntegerField(default=0)),
+                ('active_count', models.IntegerField(default=0)),
+                ('stock_total', models.BigIntegerField(default=0)),
+                ('packaged_count', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='authorization.providerprofile')),
+            ],
+            options={
+                'unique_together': {('provider', 'category')},
+            },
+        ),
+        migrations.RunPython(backfill_provider_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0006_product_effective_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='content_type',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
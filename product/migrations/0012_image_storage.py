@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:01
+
+import product.models
+import utils.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0011_imageupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageupload',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='storage_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='file',
+            field=models.ImageField(storage=utils.storage.get_image_storage, upload_to=product.models.image_blob_path),
+        ),
+        migrations.AlterField(
+            model_name='imagevariant',
+            name='file',
+            field=models.FileField(storage=utils.storage.get_image_storage, upload_to=product.models.image_variant_path),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:06
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0012_image_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='referenced_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def _clean_image_ids(value):
+    ids = []
+    for image_id in value if isinstance(value, list) else []:
+        try:
+            ids.append(int(image_id))
+        except (TypeError, ValueError):
+            pass
+    return ids
+
+
+def backfill_product_images(apps, schema_editor):
+    # Products are read in ID order, BATCH_SIZE at a time, IDs of deleted images are dropped
+    Product = apps.get_model('product', 'Product')
+    ProductImage = apps.get_model('product', 'ProductImage')
+    Image = apps.get_model('product', 'Image')
+
+    last_id = 0
+    while True:
+        rows = list(
+            Product.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'images')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        rows = [(product_id, _clean_image_ids(images)) for product_id, images in rows]
+        existing = set(Image.objects.filter(
+            id__in={image_id for _, images in rows for image_id in images}
+        ).values_list('id', flat=True))
+        ProductImage.objects.bulk_create([
+            ProductImage(product_id=product_id, image_id=image_id, position=position)
+            for product_id, images in rows
+            for position, image_id in enumerate(image_id for image_id in images if image_id in existing)
+        ], batch_size=BATCH_SIZE)
+
+
+def restore_product_images(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    ProductImage = apps.get_model('product', 'ProductImage')
+
+    images = {}
+    links = ProductImage.objects.order_by('product_id', 'position').values_list('product_id', 'image_id')
+    for product_id, image_id in links.iterator(chunk_size=BATCH_SIZE):
+        images.setdefault(product_id, []).append(image_id)
+    for product_id, image_ids in images.items():
+        Product.objects.filter(id=product_id).update(images=image_ids)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0013_image_referenced_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='product_links', to='product.image')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='image_links', to='product.product')),
+            ],
+            options={
+                'ordering': ['position'],
+                'constraints': [models.UniqueConstraint(fields=('product', 'position'), name='product_image_position_unique')],
+            },
+        ),
+        migrations.RunPython(backfill_product_images, restore_product_images),
+    ]
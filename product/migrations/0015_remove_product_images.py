@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:09
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0014_productimage'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='product',
+            name='images',
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+BATCH_SIZE = 1000
+
+
+def backfill_image_references(apps, schema_editor):
+    # Who made the earlier uploads isn't known, they become references without a user
+    Image = apps.get_model('product', 'Image')
+    ImageReference = apps.get_model('product', 'ImageReference')
+
+    last_id = 0
+    while True:
+        rows = list(
+            Image.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'ref_count')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        ImageReference.objects.bulk_create([
+            ImageReference(image_id=image_id)
+            for image_id, ref_count in rows
+            for _ in range(max(ref_count, 1))
+        ], batch_size=BATCH_SIZE)
+
+
+def restore_ref_counts(apps, schema_editor):
+    Image = apps.get_model('product', 'Image')
+    ImageReference = apps.get_model('product', 'ImageReference')
+
+    counts = ImageReference.objects.order_by().values('image_id').annotate(total=Count('id'))
+    for row in counts.iterator(chunk_size=BATCH_SIZE):
+        Image.objects.filter(id=row['image_id']).update(ref_count=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0016_product_default_manager'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageReference',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='references', to='product.image')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='image_references', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['image', 'user'], name='image_reference_owner_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_image_references, restore_ref_counts),
+    ]
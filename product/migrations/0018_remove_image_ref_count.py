@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0017_imagereference'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='image',
+            name='ref_count',
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:29
+
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+
+def merge_duplicate_images(apps, schema_editor):
+    # Concurrent uploads of the same content could store it twice. The oldest
+    # image is kept and takes over the references and links of the others.
+    # Their files are left in place, on S3 they are the same object as the kept one
+    Image = apps.get_model('product', 'Image')
+    ImageReference = apps.get_model('product', 'ImageReference')
+    ProductImage = apps.get_model('product', 'ProductImage')
+    PackagePhoto = apps.get_model('package', 'PackagePhoto')
+
+    duplicates = (
+        Image.objects.exclude(content_hash='').order_by()
+        .values('content_hash')
+        .annotate(copies=Count('id'), keep_id=Min('id'), referenced_at=Max('referenced_at'))
+        .filter(copies__gt=1)
+    )
+    # Read up front, the loop deletes rows of the grouped table
+    for row in list(duplicates):
+        copy_ids = list(
+            Image.objects.filter(content_hash=row['content_hash']).exclude(id=row['keep_id'])
+            .values_list('id', flat=True)
+        )
+        ImageReference.objects.filter(image_id__in=copy_ids).update(image_id=row['keep_id'])
+        ProductImage.objects.filter(image_id__in=copy_ids).update(image_id=row['keep_id'])
+        PackagePhoto.objects.filter(image_id__in=copy_ids).update(image_id=row['keep_id'])
+        Image.objects.filter(id=row['keep_id']).update(referenced_at=row['referenced_at'])
+        # Their variants go with them, the kept image has its own
+        Image.objects.filter(id__in=copy_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0018_remove_image_ref_count'),
+        ('package', '0010_remove_trippackage_photos'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0019_merge_duplicate_images'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='image',
+            constraint=models.UniqueConstraint(condition=models.Q(('content_hash', ''), _negated=True), fields=('content_hash',), name='image_content_hash_unique'),
+        ),
+    ]
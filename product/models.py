@@ -1,34 +1,325 @@
-from django.db import models
+import mimetypes
+import os
+import uuid
+
+from django.db import IntegrityError, models, transaction
+from django.db.models.base import DEFERRED
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from authorization.models import ProviderProfile
+from authorization.models import BaseUser, ProviderProfile
 from django.db import models
 from django.core.cache import cache
-from utils.cache_utils import invalidate_model_caches
+from events.outbox import publish, publish_cache_invalidation
+from utils.model_tracking import FieldTrackerMixin
+from utils.storage import get_image_storage
+
+
+def image_blob_path(instance, filename):
+    # Content addressed, so the file name of an image never changes
+    extension = mimetypes.guess_extension(instance.content_type) if instance.content_type else None
+    extension = extension or os.path.splitext(filename)[1].lower()
+    if not instance.content_hash:
+        return f"uploads/{filename}"
+    return f"uploads/{instance.content_hash[:2]}/{instance.content_hash}{extension}"
 
 
 class Image(models.Model):
     id = models.AutoField(primary_key=True)
-    file = models.ImageField(upload_to='uploads/')
+    file = models.ImageField(upload_to=image_blob_path, storage=get_image_storage)
+    # Detected from the content at upload, see product.imaging
+    content_type = models.CharField(max_length=100, blank=True, default='')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    # SHA-256 of the file, used as the ETag and the cache-busting version of download URLs
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # Last upload of the content, gc_images keeps unused images for IMAGE_GC_GRACE after it
+    referenced_at = models.DateTimeField(default=timezone.now)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     # uploader = models.ForeignKey(
     #     'auth.User', on_delete=models.CASCADE, related_name='images'
     # )
 
+    class Meta:
+        constraints = [
+            # One image per content, concurrent uploads of it share the row and its file
+            models.UniqueConstraint(fields=['content_hash'], condition=~Q(content_hash=''), name='image_content_hash_unique'),
+        ]
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         
-        invalidate_model_caches('image', self.id)
+        publish_cache_invalidation('image', self.id)
     
     def delete(self, *args, **kwargs):
         image_id = self.id
         super().delete(*args, **kwargs)
         
-        invalidate_model_caches('image', image_id)
+        publish_cache_invalidation('image', image_id)
+
+    @classmethod
+    def store(cls, file, content_hash, user, **fields):
+        """
+        Store an uploaded file, or add a reference to the image that already
+        has the same content.
+
+        Args:
+            file (UploadedFile or str): The uploaded file, or the name of a file
+                already in the image storage
+            content_hash (str): SHA-256 of the file
+            user (BaseUser): The uploader, who holds the new reference
+            **fields: Other fields of a new image (content_type, width, height)
+
+        Returns:
+            tuple: (image, created)
+        """
+        with transaction.atomic():
+            image = cls.add_reference(content_hash, user)
+            if image is not None:
+                return image, False
+            image = cls(file=file, content_hash=content_hash, **fields)
+            try:
+                with transaction.atomic():
+                    image.save()
+            except IntegrityError:
+                # Stored by a concurrent upload of the same content
+                existing = cls.add_reference(content_hash, user)
+                if existing is None:
+                    raise
+                if not isinstance(file, str) and image.file.name != existing.file.name:
+                    # Saved under another name by a storage that doesn't overwrite
+                    image.file.storage.delete(image.file.name)
+                return existing, False
+            ImageReference.objects.create(image=image, user=user)
+            return image, True
+
+    @classmethod
+    def add_reference(cls, content_hash, user):
+        """
+        Add a reference held by `user` to the image with this content, if there is one.
+
+        Returns:
+            Image or None
+        """
+        with transaction.atomic():
+            image = (
+                cls.objects.select_for_update()
+                .filter(content_hash=content_hash)
+                .order_by('id')
+                .first()
+            )
+            if image is not None:
+                image.referenced_at = timezone.now()
+                cls.objects.filter(id=image.id).update(referenced_at=image.referenced_at)
+                ImageReference.objects.create(image=image, user=user)
+            return image
+
+    def release(self, user):
+        """
+        Drop one of the references `user` holds to the image. Dropping the last
+        reference deletes the image, and its file and variant files once the
+        transaction commits.
+
+        Returns:
+            bool: True if the image was deleted
+
+        Raises:
+            ImageReference.DoesNotExist: If the user holds no reference to the image
+        """
+        with transaction.atomic():
+            # Locked so a concurrent upload can't add a reference to an image being deleted
+            if not Image.objects.select_for_update().filter(id=self.id).exists():
+                raise ImageReference.DoesNotExist("Image not found.")
+            reference = self.references.filter(user=user).order_by('id').first()
+            if reference is None:
+                raise ImageReference.DoesNotExist("Image not found.")
+            reference.delete()
+            if self.references.exists():
+                return False
+
+            Image.purge([self.id])
+        return True
+
+    @classmethod
+    def purge(cls, image_ids):
+        """
+        Delete images whatever references they have left, and their file and
+        variant files once the transaction commits.
+
+        Args:
+            image_ids (list): IDs of the images
+
+        Returns:
+            int: Number of images deleted
+        """
+        from package.models import PackagePhoto
+
+        with transaction.atomic():
+            images = list(cls.objects.filter(id__in=image_ids).only('id', 'file'))
+            if not images:
+                return 0
+            files = [image.file for image in images]
+            files += [variant.file for variant in ImageVariant.objects.filter(image__in=images).only('file')]
+            # The links are deleted with the images, their owners' cached responses list them
+            product_ids = set(ProductImage.objects.filter(image__in=images).values_list('product_id', flat=True))
+            package_ids = set(PackagePhoto.objects.filter(image__in=images).values_list('package_id', flat=True))
+            cls.objects.filter(id__in=[image.id for image in images]).delete()
+            transaction.on_commit(lambda: [file.delete(save=False) for file in files if file])
+
+            for image in images:
+                publish_cache_invalidation('image', image.id)
+            for product_id in product_ids:
+                publish_cache_invalidation('product', product_id, related_models=['package'])
+            for package_id in package_ids:
+                publish_cache_invalidation('package', package_id, related_models=['product'])
+        return len(images)
     
     def __str__(self):
         return f"Image {self.id}"
 
-class Product(models.Model):
+class ImageReference(models.Model):
+    """
+    An upload of an image's content, held by the uploader. Uploads of the same
+    content share one Image, which is deleted with its last reference.
+    """
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='references')
+    # Null for uploads made before references were recorded
+    user = models.ForeignKey(BaseUser, on_delete=models.CASCADE, null=True, blank=True, related_name='image_references')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['image', 'user'], name='image_reference_owner_idx'),
+        ]
+
+    def __str__(self):
+        return f"Image {self.image_id} reference of user {self.user_id}"
+
+
+def image_variant_path(instance, filename):
+    return f"uploads/variants/{instance.image_id}/{filename}"
+
+
+class ImageVariant(models.Model):
+    """
+    A resized and re-encoded copy of an Image, generated by product.image_variants.
+    """
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='variants')
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    format = models.CharField(max_length=10)
+    file = models.FileField(upload_to=image_variant_path, storage=get_image_storage)
+    size = models.PositiveIntegerField()
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('image', 'width', 'format')
+
+    def __str__(self):
+        return f"Image {self.image_id} {self.width}w {self.format}"
+
+
+class ImageUpload(models.Model):
+    """
+    An image upload in progress, see product.uploads. Chunked uploads keep
+    the received bytes in IMAGE_UPLOAD_TEMP_DIR until they are completed,
+    direct uploads are sent by the client straight to the image storage.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(BaseUser, on_delete=models.CASCADE, related_name='image_uploads')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    # Filled in once the first chunks identify the image
+    content_type = models.CharField(max_length=100, blank=True, default='')
+    # Direct uploads: the client sends the file to this name in the image storage
+    storage_name = models.CharField(max_length=255, blank=True, default='')
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.id} ({self.received}/{self.size})"
+
+
+def set_image_links(links, image_ids):
+    """
+    Replace the image links of an object, e.g. `product.image_links`, with
+    links to `image_ids` in that order.
+
+    Args:
+        links: The reverse manager of the link model
+        image_ids (list): Image IDs, they must exist
+
+    Returns:
+        bool: Whether the images changed
+    """
+    image_ids = list(image_ids)
+    if [link.image_id for link in links.all()] == image_ids:
+        return False
+
+    owner_field = links.field.name
+    with transaction.atomic():
+        links.all().delete()
+        links.model.objects.bulk_create([
+            links.model(**{owner_field: links.instance}, image_id=image_id, position=position)
+            for position, image_id in enumerate(image_ids)
+        ])
+    # Drop links prefetched before the change
+    getattr(links.instance, '_prefetched_objects_cache', {}).pop(links.field.remote_field.get_accessor_name(), None)
+    return True
+
+
+class ProductQuerySet(models.QuerySet):
+    def alive(self):
+        return self.filter(deleted_at__isnull=True)
+
+    def deleted(self):
+        return self.filter(deleted_at__isnull=False)
+
+    def soft_delete(self):
+        """
+        Tombstone the products with a single UPDATE. They disappear from
+        Product.objects and are hard deleted later by the purge_products command.
+        """
+        stats_deltas = self.provider_stats_deltas(sign=-1)
+        count = self.alive().update(deleted_at=timezone.now(), isActive=False)
+        if count:
+            publish_cache_invalidation('product', related_models=['package'])
+            publish_provider_stats(deltas=stats_deltas, recount=[row[:2] for row in stats_deltas])
+        return count
+
+    def delete(self):
+        stats_deltas = self.provider_stats_deltas(sign=-1)
+        result = super().delete()
+        publish_provider_stats(deltas=stats_deltas, recount=[row[:2] for row in stats_deltas])
+        return result
+
+    def provider_stats_deltas(self, sign=1):
+        """
+        The contribution of the live products in the queryset to ProviderStats,
+        as delta rows (see publish_provider_stats), with one aggregate query.
+        """
+        return [
+            [row['provider_id'], row['category'], sign * row['products'], sign * row['active'], sign * row['stock']]
+            for row in self.alive().order_by().values('provider_id', 'category').annotate(
+                products=Count('id'),
+                active=Count('id', filter=Q(isActive=True)),
+                stock=Coalesce(Sum('stock'), 0),
+            )
+        ]
+
+
+class ProductManager(models.Manager.from_queryset(ProductQuerySet)):
+    """Product.objects, hides soft deleted products"""
+    def get_queryset(self):
+        return super().get_queryset().alive()
+
+
+class Product(FieldTrackerMixin, models.Model):
     CATEGORY_CHOICES = [
         ('flight', 'Flight Ticket'),
         ('train', 'Train Ticket'),
@@ -43,25 +334,282 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     discount = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)
+    # Computed and stored by the database, so price range filters and sorting can use an index
+    effective_price = models.GeneratedField(
+        expression=F('price') - F('discount'),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        db_persist=True,
+    )
     stock = models.IntegerField()
     category = models.CharField(max_length=100, choices=CATEGORY_CHOICES)
-    images = models.JSONField(default=list)
     isActive = models.BooleanField(default=True)
     provider = models.ForeignKey(ProviderProfile, on_delete=models.CASCADE, related_name='products')
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    PROVIDER_STATS_FIELDS = ('provider_id', 'category', 'isActive', 'stock', 'deleted_at')
+
+    objects = ProductManager()
+    # Includes soft deleted products
+    all_objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # Relations resolve soft deleted products: packages keep showing their
+        # activities like their flight and hotel, and activities.set() sees them.
+        # Listings and lookups go through `objects` to hide them
+        default_manager_name = 'all_objects'
+        # Partial indexes: lists only read live products, the purge only reads tombstones
+        indexes = [
+            models.Index(fields=['effective_price'], name='product_effective_price_idx', condition=Q(deleted_at__isnull=True)),
+            models.Index(fields=['category', 'effective_price'], name='product_category_price_idx', condition=Q(deleted_at__isnull=True)),
+            models.Index(fields=['deleted_at'], name='product_deleted_at_idx', condition=Q(deleted_at__isnull=False)),
+        ]
+
+    # Fields exposed by the product serializers or used to scope product lists;
+    # saves that change none of them keep the caches
+    tracked_fields = (
+        'name', 'summary', 'description', 'price', 'discount', 'stock',
+        'category', 'isActive', 'provider_id', 'created_at', 'deleted_at',
+    )
 
     def __str__(self):
         return self.name
 
+    @property
+    def image_ids(self):
+        """IDs of the product's images in order, from the prefetched image_links if loaded"""
+        return [link.image_id for link in self.image_links.all()]
+
+    def set_images(self, image_ids):
+        """Replace the product's images with these image IDs, in that order"""
+        if set_image_links(self.image_links, image_ids):
+            publish_cache_invalidation('product', self.id, related_models=['package'])
+
+    def provider_stats_changes(self, update_fields=None):
+        """
+        Work out how saving this product changes ProviderStats, from the tracked
+        original values. Must be called before the save.
+
+        Returns:
+            tuple: (delta rows, pairs whose packaged_count must be recounted), see publish_provider_stats
+        """
+        def contribution(values, sign):
+            if values['deleted_at'] is not None:
+                return None
+            return [values['provider_id'], values['category'], sign, sign * int(bool(values['isActive'])), sign * values['stock']]
+
+        new_values = {
+            name: self.__dict__.get(name, DEFERRED) if update_fields is None or self._field_in(name, update_fields)
+            else self.get_original_value(name)
+            for name in self.PROVIDER_STATS_FIELDS
+        }
+        if self._state.adding:
+            new_row = contribution(new_values, 1)
+            return ([new_row] if new_row else []), []
+
+        old_values = {name: self.get_original_value(name) for name in self.PROVIDER_STATS_FIELDS}
+        if any(value is DEFERRED for value in list(old_values.values()) + list(new_values.values())):
+            # Loaded with deferred fields, read what is stored now
+            stored = Product.all_objects.filter(pk=self.pk).values(*self.PROVIDER_STATS_FIELDS).first()
+            if stored is None:
+                return [], []
+            old_values = stored
+            new_values = {name: stored[name] if value is DEFERRED else value for name, value in new_values.items()}
+
+        if old_values == new_values:
+            return [], []
+
+        rows = [row for row in (contribution(old_values, -1), contribution(new_values, 1)) if row]
+        recount = []
+        if (old_values['provider_id'], old_values['category'], old_values['deleted_at'] is None) \
+                != (new_values['provider_id'], new_values['category'], new_values['deleted_at'] is None):
+            # The product moved between summaries, so packaged_count may change for both
+            recount = [[old_values['provider_id'], old_values['category']], [new_values['provider_id'], new_values['category']]]
+        return rows, recount
+
     def save(self, *args, **kwargs):
-        # Clear cache when a product is saved or updated
+        # Clear cache when a visible field of the product is saved or updated
+        update_fields = kwargs.get('update_fields')
+        visible_change = self.has_tracked_changes(update_fields)
+        stats_deltas, stats_recount = self.provider_stats_changes(
+            set(update_fields) if update_fields is not None else None
+        )
         super().save(*args, **kwargs)
         
-        invalidate_model_caches('product', self.id, related_models=['package'])
+        if visible_change:
+            publish_cache_invalidation('product', self.id, related_models=['package'])
+        publish_provider_stats(deltas=stats_deltas, recount=stats_recount)
     
     def delete(self, *args, **kwargs):
         product_id = self.id
+        stats_deltas = Product.all_objects.filter(pk=self.pk).provider_stats_deltas(sign=-1)
         super().delete(*args, **kwargs)
         
-        invalidate_model_caches('product', product_id, related_models=['package'])
+        publish_cache_invalidation('product', product_id, related_models=['package'])
+        publish_provider_stats(deltas=stats_deltas, recount=[row[:2] for row in stats_deltas])
+
+
+class ProductImage(models.Model):
+    """An image of a product, `position` orders the images as the API lists them"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='image_links')
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='product_links')
+    position = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'position'], name='product_image_position_unique'),
+        ]
+
+    def __str__(self):
+        return f"Product {self.product_id} image {self.position}: {self.image_id}"
+
+
+def publish_provider_stats(deltas=(), recount=()):
+    """
+    Publish changes to the ProviderStats summaries.
+
+    Args:
+        deltas (list): [provider_id, category, products, active, stock] rows added to the counters
+        recount (list): [provider_id, category] pairs whose packaged_count is recounted
+    """
+    totals = {}
+    for provider_id, category, products, active, stock in deltas:
+        pair_totals = totals.setdefault((provider_id, category), [0, 0, 0])
+        pair_totals[0] += products
+        pair_totals[1] += active
+        pair_totals[2] += stock
+
+    rows = [[provider_id, category, *pair_totals] for (provider_id, category), pair_totals in totals.items() if any(pair_totals)]
+    if rows:
+        publish('provider_stats.delta', {'rows': rows})
+    if recount:
+        publish('provider_stats.recount', {'pairs': sorted({tuple(pair) for pair in recount})})
+
+
+def publish_packaged_recount(product_ids):
+    """Recount packaged_count for the summaries these products belong to"""
+    product_ids = [product_id for product_id in product_ids if product_id is not None]
+    if product_ids:
+        pairs = Product.objects.filter(id__in=product_ids).order_by().values_list('provider_id', 'category').distinct()
+        publish_provider_stats(recount=list(pairs))
+
+
+class ProviderStats(models.Model):
+    """
+    Per provider and category product summary for the provider dashboard.
+    Counters are updated with deltas as products are saved, and packaged_count
+    is recounted for the affected categories when packages change, so reads
+    never scan Product.
+
+    Soft deleted products are not counted.
+    """
+    provider = models.ForeignKey(ProviderProfile, on_delete=models.CASCADE, related_name='stats')
+    category = models.CharField(max_length=100, choices=Product.CATEGORY_CHOICES)
+    products_count = models.IntegerField(default=0)
+    active_count = models.IntegerField(default=0)
+    stock_total = models.BigIntegerField(default=0)
+    packaged_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('provider', 'category')
+
+    @classmethod
+    def apply_deltas(cls, rows):
+        """
+        Add [provider_id, category, products, active, stock] rows to the counters,
+        with one update per summary.
+        """
+        totals = {}
+        for provider_id, category, products, active, stock in rows:
+            pair_totals = totals.setdefault((provider_id, category), [0, 0, 0])
+            pair_totals[0] += products
+            pair_totals[1] += active
+            pair_totals[2] += stock
+
+        for (provider_id, category), (products, active, stock) in totals.items():
+            cls._update_or_create(
+                provider_id, category,
+                updates={
+                    'products_count': F('products_count') + products,
+                    'active_count': F('active_count') + active,
+                    'stock_total': F('stock_total') + stock,
+                },
+                values={'products_count': products, 'active_count': active, 'stock_total': stock},
+            )
+
+    @classmethod
+    def _update_or_create(cls, provider_id, category, updates, values):
+        """
+        Apply `updates` to the summary of a pair, or create it with `values`
+        if the pair has none yet and the provider still exists.
+        """
+        stats = cls.objects.filter(provider_id=provider_id, category=category)
+        if stats.update(updated_at=timezone.now(), **updates):
+            return
+        if not ProviderProfile.objects.filter(id=provider_id).exists():
+            return
+        try:
+            # In a savepoint, so a failed create leaves the caller's transaction usable
+            with transaction.atomic():
+                cls.objects.create(provider_id=provider_id, category=category, **values)
+        except IntegrityError:
+            # Created by a concurrent first write of the pair meanwhile
+            stats.update(updated_at=timezone.now(), **updates)
+
+    @staticmethod
+    def _summarize(products, full=True):
+        from package.models import TripPackage
+
+        in_package = Q(Exists(TripPackage.objects.filter(Q(flight=OuterRef('pk')) | Q(hotel=OuterRef('pk'))))) \
+            | Q(Exists(TripPackage.activities.through.objects.filter(product=OuterRef('pk'))))
+        counters = {'packaged_count': Count('id', filter=in_package)}
+        if full:
+            counters.update(
+                products_count=Count('id'),
+                active_count=Count('id', filter=Q(isActive=True)),
+                stock_total=Coalesce(Sum('stock'), 0),
+            )
+        return products.order_by().values('provider_id', 'category').annotate(**counters)
+
+    @classmethod
+    def recount_packaged(cls, pairs):
+        """
+        Recount packaged_count of (provider_id, category) pairs. Unlike the other
+        counters it is always recounted, package changes don't say which
+        products stopped being used.
+        """
+        for provider_id, category in set(map(tuple, pairs)):
+            summary = next(iter(cls._summarize(
+                Product.objects.filter(provider_id=provider_id, category=category), full=False
+            )), None)
+            packaged_count = summary['packaged_count'] if summary else 0
+            if packaged_count:
+                cls._update_or_create(
+                    provider_id, category,
+                    updates={'packaged_count': packaged_count}, values={'packaged_count': packaged_count},
+                )
+            else:
+                cls.objects.filter(provider_id=provider_id, category=category).update(
+                    packaged_count=0, updated_at=timezone.now()
+                )
+
+    @classmethod
+    def rebuild(cls, provider_ids=None):
+        """Recompute all summaries, or those of the given providers"""
+        products = Product.objects.all()
+        stats = cls.objects.all()
+        if provider_ids is not None:
+            products = products.filter(provider_id__in=provider_ids)
+            stats = stats.filter(provider_id__in=provider_ids)
+
+        summaries = list(cls._summarize(products))
+        stats.delete()
+        cls.objects.bulk_create([cls(**summary) for summary in summaries], batch_size=500)
+        return len(summaries)
+
+    def __str__(self):
+        return f"{self.provider} - {self.category}"
+
@@ -1,26 +1,150 @@
+from urllib.parse import urlencode
+
+from django.db.models import Prefetch
+from django.urls import reverse
 from .models import Product
 from rest_framework import serializers
-from .models import Image
+from utils.serializers import DynamicFieldsMixin
+from .models import Image, ImageVariant
 
 class ImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Image
         fields = ['id', 'file', 'uploaded_at']
 
-class ProductSerializer(serializers.ModelSerializer):
-    images = serializers.ListField(
-        child=serializers.IntegerField(),
-        allow_empty=True,
-        default=list
+class ImageMetadataSerializer(serializers.ModelSerializer):
+    """
+    What a client needs to display an image without downloading it first. The
+    URLs carry the content hash, so they are cached as immutable.
+    """
+    url = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Image
+        fields = ['id', 'url', 'width', 'height', 'content_type', 'content_hash', 'variants']
+
+    def _download_url(self, image, **params):
+        if image.content_hash:
+            params['v'] = image.content_hash
+        url = reverse('image-download', args=[image.id])
+        if params:
+            url += '?' + urlencode(params)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def get_url(self, image):
+        return self._download_url(image)
+
+    def get_variants(self, image):
+        return [
+            {
+                'width': variant.width,
+                'height': variant.height,
+                'format': variant.format,
+                'size': variant.size,
+                'url': self._download_url(image, w=variant.width, fmt=variant.format),
+            }
+            for variant in image.variants.all()
+        ]
+
+def get_image_metadata(image_ids, request=None):
+    """
+    Serialize many images at once, with one query for the images and one for
+    their variants.
+
+    Args:
+        image_ids (iterable): Image IDs, e.g. all photos of a page of packages
+        request (optional): Used to build absolute URLs
+
+    Returns:
+        dict: image id -> ImageMetadataSerializer data, unknown IDs are left out
+    """
+    image_ids = {image_id for image_id in image_ids if isinstance(image_id, int)}
+    if not image_ids:
+        return {}
+    images = Image.objects.filter(id__in=image_ids).prefetch_related(
+        Prefetch('variants', queryset=ImageVariant.objects.order_by('format', 'width'))
     )
+    return {
+        data['id']: data
+        for data in ImageMetadataSerializer(images, many=True, context={'request': request}).data
+    }
+
+class ImageMetadataListField(serializers.Field):
+    """
+    A read-only list of image IDs rendered as image metadata, taken from the
+    `images` dict of the serializer context (see get_image_metadata).
+    """
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        images = self.context.get('images', {})
+        return [images[image_id] for image_id in value or [] if image_id in images]
+
+class ImageIdListField(serializers.ListField):
+    """
+    The ordered image IDs of an object, e.g. Product.image_ids, as a list of
+    IDs. IDs of images that don't exist are rejected.
+    """
+    child = serializers.IntegerField()
+
+    def to_internal_value(self, data):
+        image_ids = super().to_internal_value(data)
+        existing = set(Image.objects.filter(id__in=image_ids).values_list('id', flat=True))
+        unknown = [str(image_id) for image_id in dict.fromkeys(image_ids) if image_id not in existing]
+        if unknown:
+            raise serializers.ValidationError(f"Unknown image IDs: {', '.join(unknown)}")
+        return image_ids
+
+def expand_image_fields(serializer, field_names, expand):
+    """Render the image ID list fields listed in `expand` as image metadata"""
+    for field_name in field_names:
+        if field_name in serializer.fields and field_name in (expand or ()):
+            source = serializer.fields[field_name].source
+            serializer.fields[field_name] = ImageMetadataListField(
+                **({'source': source} if source and source != field_name else {})
+            )
+
+class ExpandableImagesMixin:
+    """
+    A serializer mixin that takes an optional `expand` argument. The image ID
+    lists it names are rendered as image metadata, which has to be loaded in
+    the context as `images` first.
+    """
+    expandable_image_fields = ('images',)
+
+    def __init__(self, *args, **kwargs):
+        expand = kwargs.pop('expand', None)
+        super().__init__(*args, **kwargs)
+        expand_image_fields(self, self.expandable_image_fields, expand)
+
+class ProductSerializer(ExpandableImagesMixin, DynamicFieldsMixin, serializers.ModelSerializer):
+    images = ImageIdListField(source='image_ids', allow_empty=True, default=list)
+    effective_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
 
     class Meta:
         model = Product
         fields = [
             'id', 'name', 'summary', 'description', 'price', 
-            'discount', 'stock', 'category', 'images', 'isActive',
+            'discount', 'effective_price', 'stock', 'category', 'images', 'isActive',
             'created_at', 'updated_at'
         ]
 
     # def get_images(self, obj):
     #     return obj.images[0] if obj.images else None
+
+    def create(self, validated_data):
+        image_ids = validated_data.pop('image_ids', [])
+        product = super().create(validated_data)
+        product.set_images(image_ids)
+        return product
+
+    def update(self, instance, validated_data):
+        image_ids = validated_data.pop('image_ids', None)
+        instance = super().update(instance, validated_data)
+        if image_ids is not None:
+            instance.set_images(image_ids)
+        return instance
@@ -0,0 +1,83 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, When
+
+from events.outbox import publish_cache_invalidation
+from .models import Product, publish_provider_stats
+
+STOCK_UPDATE_CHUNK_SIZE = 500
+
+
+def apply_stock_deltas(provider, deltas, allow_partial=False):
+    """
+    Add a per-product delta to the stock of the provider's products.
+
+    The current stock of all products is read with one locking query, and the
+    updates are written with one CASE statement per chunk, with products
+    sharing the same delta grouped in a single WHEN. The statement also keeps
+    the non-negative check so stock can't go below zero.
+
+    Args:
+        provider (ProviderProfile): Owner of the products
+        deltas (dict): product_id -> stock change
+        allow_partial (bool): Apply the valid deltas even if some products fail
+
+    Returns:
+        tuple: (applied, results) where results is a list of
+            {'id', 'status', 'stock'} with status 'updated', 'not_found', 'insufficient_stock'
+            or 'skipped' (valid, but not applied because other products failed)
+    """
+    with transaction.atomic():
+        current_stock = {}
+        categories = {}
+        for product_id, stock, category in (
+            Product.objects
+            .select_for_update()
+            .filter(id__in=deltas.keys(), provider=provider)
+            .values_list('id', 'stock', 'category')
+        ):
+            current_stock[product_id] = stock
+            categories[product_id] = category
+
+        results = []
+        valid = {}
+        for product_id, delta in deltas.items():
+            stock = current_stock.get(product_id)
+            if stock is None:
+                results.append({'id': product_id, 'status': 'not_found', 'stock': None})
+            elif stock + delta < 0:
+                results.append({'id': product_id, 'status': 'insufficient_stock', 'stock': stock})
+            else:
+                valid[product_id] = delta
+                results.append({'id': product_id, 'status': 'updated', 'stock': stock + delta})
+
+        if len(valid) != len(deltas) and not allow_partial:
+            for result in results:
+                if result['status'] == 'updated':
+                    result['status'] = 'skipped'
+                    result['stock'] = current_stock[result['id']]
+            return False, results
+
+        product_ids = list(valid.keys())
+        for start in range(0, len(product_ids), STOCK_UPDATE_CHUNK_SIZE):
+            chunk = product_ids[start:start + STOCK_UPDATE_CHUNK_SIZE]
+            ids_by_delta = defaultdict(list)
+            for product_id in chunk:
+                ids_by_delta[valid[product_id]].append(product_id)
+
+            Product.objects.filter(id__in=chunk).update(stock=Case(
+                *[
+                    When(id__in=ids, stock__gte=-delta, then=F('stock') + delta)
+                    for delta, ids in ids_by_delta.items()
+                ],
+                default=F('stock'),
+            ))
+
+        if valid:
+            publish_cache_invalidation('product', related_models=['package'])
+            publish_provider_stats(deltas=[
+                [provider.id, categories[product_id], 0, 0, delta] for product_id, delta in valid.items()
+            ])
+
+    return True, results
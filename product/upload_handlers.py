@@ -0,0 +1,46 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from rest_framework.parsers import MultiPartParser
+
+
+class HashingUploadMixin:
+    """
+    Compute the SHA-256 of an uploaded file while its chunks are received and
+    set it as `content_hash` on the resulting file, so it isn't read twice.
+    """
+    def new_file(self, *args, **kwargs):
+        # Before super(): the memory handler stops the other handlers by raising
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_hash = self.sha256.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+class HashingMultiPartParser(MultiPartParser):
+    """
+    MultiPartParser whose uploaded files carry their SHA-256 in `content_hash`.
+    """
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context['request']
+        request.upload_handlers = [
+            HashingMemoryFileUploadHandler(request._request),
+            HashingTemporaryFileUploadHandler(request._request),
+        ]
+        return super().parse(stream, media_type, parser_context)
@@ -0,0 +1,286 @@
+import io
+import os
+import re
+import shutil
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from utils.exceptions import ResourceNotFoundError, ValidationError
+from utils.storage import get_image_storage, supports_direct_upload
+from .imaging import hash_file, inspect_image
+from .models import Image, ImageUpload, image_blob_path
+
+STREAM_CHUNK_SIZE = 64 * 1024
+# Enough for the header of a JPEG with a large EXIF block
+SNIFF_SIZE = 256 * 1024
+
+_sha256_re = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadOffsetMismatch(Exception):
+    """A chunk doesn't start where the received bytes end"""
+    def __init__(self, received):
+        super().__init__(f"Expected a chunk starting at byte {received}.")
+        self.received = received
+
+
+def check_image_limits(content_type, width, height, size):
+    """
+    Check an image against the IMAGE_UPLOAD_* limits.
+
+    Args:
+        content_type (str): Detected MIME type
+        width (int): Width, None if the file isn't a readable image
+        height (int): Height
+        size (int): Size in bytes
+
+    Raises:
+        ValidationError: If a limit is exceeded
+    """
+    if size > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise ValidationError(f"Images are limited to {settings.IMAGE_UPLOAD_MAX_SIZE} bytes.")
+    if width is None or content_type not in settings.IMAGE_UPLOAD_ALLOWED_TYPES:
+        raise ValidationError(
+            "File is not a supported image, allowed types are " + ", ".join(settings.IMAGE_UPLOAD_ALLOWED_TYPES)
+        )
+    if width * height > settings.IMAGE_UPLOAD_MAX_PIXELS:
+        raise ValidationError(f"Images are limited to {settings.IMAGE_UPLOAD_MAX_PIXELS} pixels.")
+
+
+def upload_path(upload):
+    return os.path.join(settings.IMAGE_UPLOAD_TEMP_DIR, str(upload.id))
+
+
+def get_upload(user, upload_id):
+    """
+    The user's upload with this ID, unless it expired.
+
+    Raises:
+        ResourceNotFoundError: If there is no such upload
+    """
+    upload = ImageUpload.objects.filter(
+        id=upload_id, user=user,
+        updated_at__gte=timezone.now() - settings.IMAGE_UPLOAD_EXPIRY,
+    ).first()
+    if upload is None:
+        raise ResourceNotFoundError("Upload not found or expired.")
+    return upload
+
+
+def start_upload(user, filename, size):
+    """
+    Start a chunked upload of `size` bytes.
+
+    Raises:
+        ValidationError: If the size is over IMAGE_UPLOAD_MAX_SIZE
+    """
+    if size <= 0:
+        raise ValidationError("size must be a positive integer.")
+    if size > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise ValidationError(f"Images are limited to {settings.IMAGE_UPLOAD_MAX_SIZE} bytes.")
+
+    upload = ImageUpload.objects.create(user=user, filename=filename[:255], size=size)
+    os.makedirs(settings.IMAGE_UPLOAD_TEMP_DIR, exist_ok=True)
+    open(upload_path(upload), 'wb').close()
+    return upload
+
+
+def abort_upload(upload):
+    """Delete an upload and its received bytes"""
+    path = upload_path(upload)
+    upload.delete()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _identify(upload, path):
+    # The first bytes are enough for Pillow to read the type and size, so
+    # invalid files are rejected before the rest is sent
+    with open(path, 'rb') as file:
+        head = file.read(SNIFF_SIZE)
+    content_type, width, height = inspect_image(io.BytesIO(head))
+    if width is None and upload.received < min(SNIFF_SIZE, upload.size):
+        # Header not complete yet
+        return
+
+    try:
+        check_image_limits(content_type, width, height, upload.size)
+    except ValidationError:
+        abort_upload(upload)
+        raise
+
+    upload.content_type, upload.width, upload.height = content_type, width, height
+    ImageUpload.objects.filter(id=upload.id).update(content_type=content_type, width=width, height=height)
+
+
+def append_chunk(upload, offset, stream, length):
+    """
+    Append a chunk read from a stream, in small pieces, at the end of the
+    received bytes. A chunk cut short by a dropped connection keeps what was
+    received, so the client can resume from `upload.received`.
+
+    The chunk is first written to a part file of its own. Only the request
+    whose offset still matches appends it to the upload, while the row is
+    locked by the conditional UPDATE, so a client re-sending a chunk while
+    the first attempt is still streaming can't interleave the two.
+
+    Args:
+        upload (ImageUpload): The upload
+        offset (int): Where the chunk starts, must equal upload.received
+        stream: File-like object the chunk is read from, e.g. the request
+        length (int): Size of the chunk
+
+    Returns:
+        ImageUpload: The upload with `received` updated
+
+    Raises:
+        UploadOffsetMismatch: If the offset isn't upload.received
+        ValidationError: If the chunk is too large, or the first chunks aren't an accepted image
+    """
+    if offset != upload.received:
+        raise UploadOffsetMismatch(upload.received)
+    if length > settings.IMAGE_UPLOAD_CHUNK_SIZE:
+        raise ValidationError(f"Chunks are limited to {settings.IMAGE_UPLOAD_CHUNK_SIZE} bytes.")
+    if offset + length > upload.size:
+        raise ValidationError(f"The upload was started with a size of {upload.size} bytes.")
+
+    path = upload_path(upload)
+    part_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        written = 0
+        with open(part_path, 'wb') as part:
+            while written < length:
+                data = stream.read(min(STREAM_CHUNK_SIZE, length - written))
+                if not data:
+                    break
+                part.write(data)
+                written += len(data)
+
+        with transaction.atomic():
+            # Conditional on the offset, so only one request can append at this offset.
+            # The row stays locked until the chunk is in the file
+            updated = ImageUpload.objects.filter(id=upload.id, received=offset).update(
+                received=offset + written, updated_at=timezone.now(),
+            )
+            if not updated:
+                raise UploadOffsetMismatch(ImageUpload.objects.get(id=upload.id).received)
+            with open(path, 'r+b') as file, open(part_path, 'rb') as part:
+                file.seek(offset)
+                # Drop anything written after the recorded offset by an interrupted append
+                file.truncate()
+                shutil.copyfileobj(part, file, STREAM_CHUNK_SIZE)
+    finally:
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+    upload.received = offset + written
+
+    if not upload.content_type:
+        _identify(upload, path)
+    return upload
+
+
+def start_direct_upload(user, filename, size, content_type, sha256):
+    """
+    Start an upload the client sends straight to the image storage with a
+    presigned URL. The file is content addressed: if an image with the same
+    hash exists it is reused and nothing has to be uploaded.
+
+    Args:
+        user (BaseUser): The uploader
+        filename (str): Name of the file
+        size (int): Size in bytes
+        content_type (str): MIME type of the file
+        sha256 (str): Hex SHA-256 of the file, checked by the storage
+
+    Returns:
+        tuple: (image, None, None) if the content already exists, otherwise
+            (None, upload, dict with the 'url', 'method' and 'headers' to upload with)
+
+    Raises:
+        ValidationError: If the storage has no direct uploads, or the file is over the limits
+    """
+    storage = get_image_storage()
+    if not supports_direct_upload(storage):
+        raise ValidationError("Direct uploads need an object storage, use image/upload/init/ instead.")
+    if size <= 0:
+        raise ValidationError("size must be a positive integer.")
+    if size > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise ValidationError(f"Images are limited to {settings.IMAGE_UPLOAD_MAX_SIZE} bytes.")
+    if content_type not in settings.IMAGE_UPLOAD_ALLOWED_TYPES:
+        raise ValidationError("contentType must be one of " + ", ".join(settings.IMAGE_UPLOAD_ALLOWED_TYPES))
+    sha256 = str(sha256).lower()
+    if not _sha256_re.match(sha256):
+        raise ValidationError("sha256 must be the hex SHA-256 of the file.")
+
+    image = Image.add_reference(sha256, user)
+    if image is not None:
+        return image, None, None
+
+    name = image_blob_path(Image(content_hash=sha256, content_type=content_type), filename)
+    upload = ImageUpload.objects.create(
+        user=user, filename=filename[:255], size=size,
+        storage_name=name, content_hash=sha256,
+    )
+    return None, upload, storage.presigned_put(name, content_type, size, sha256)
+
+
+def _complete_direct_upload(upload):
+    storage = get_image_storage()
+    name = upload.storage_name
+    if not storage.exists(name) or storage.size(name) != upload.size:
+        raise ValidationError("The file hasn't been uploaded to the storage yet.")
+
+    # Only the header is read back, the storage already checked the checksum
+    with storage.open(name) as file:
+        content_type, width, height = inspect_image(io.BytesIO(file.read(SNIFF_SIZE)))
+    try:
+        check_image_limits(content_type, width, height, upload.size)
+    except ValidationError:
+        storage.delete(name)
+        abort_upload(upload)
+        raise
+
+    image, created = Image.store(
+        name, upload.content_hash, upload.user, content_type=content_type, width=width, height=height,
+    )
+    if not created and image.file.name != name:
+        # Stored meanwhile under another name, e.g. before names were content addressed
+        storage.delete(name)
+    abort_upload(upload)
+    return image, created
+
+
+def complete_upload(upload):
+    """
+    Store a fully received upload as an Image, deduplicated like regular
+    uploads, and delete the upload.
+
+    Returns:
+        tuple: (image, created)
+
+    Raises:
+        ValidationError: If bytes are missing
+    """
+    if upload.storage_name:
+        return _complete_direct_upload(upload)
+    if upload.received != upload.size:
+        raise ValidationError(f"Upload incomplete, {upload.received} of {upload.size} bytes received.")
+    if not upload.content_type:
+        raise ValidationError("File is not a supported image.")
+
+    with open(upload_path(upload), 'rb') as file:
+        content_hash = hash_file(file)
+        image, created = Image.store(
+            File(file, name=upload.filename), content_hash, upload.user,
+            content_type=upload.content_type, width=upload.width, height=upload.height,
+        )
+    abort_upload(upload)
+    return image, created
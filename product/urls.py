@@ -1,6 +1,17 @@
+from django.conf import settings
 from django.urls import path
+from .async_views import AsyncImageDownloadView, AsyncImageUploadView
 from .views import ProductCreateView, ProductListView, ProductDetailsView, ImageUploadView, ImageDeleteView, \
-    ImageDownloadView, ProductActivateView, ProductDeactivateView, ProductChangeStockView, ProductBulkDeleteView, AllProductsListView
+    ImageDownloadView, ProductActivateView, ProductDeactivateView, ProductChangeStockView, ProductBulkDeleteView, AllProductsListView, \
+    ProductImportView, ProviderStatsView, ImageUploadInitView, ImageUploadChunkView, ImageUploadCompleteView, \
+    ImageBatchView, ImageDirectUploadView, LocalStoragePutView
+
+if settings.IMAGE_ASYNC_VIEWS:
+    image_upload_view = AsyncImageUploadView.as_view()
+    image_download_view = AsyncImageDownloadView.as_view()
+else:
+    image_upload_view = ImageUploadView.as_view()
+    image_download_view = ImageDownloadView.as_view()
 
 urlpatterns = [
     path('product/', ProductCreateView.as_view(), name='product-create'),
@@ -8,10 +19,18 @@ urlpatterns = [
     path('product/<int:product_id>/activate', ProductActivateView.as_view(), name='product-activate'),
     path('product/<int:product_id>/deactivate', ProductDeactivateView.as_view(), name='product-deactivate'),
     path('product/changeProductsAmountBy', ProductChangeStockView.as_view(), name='change-products-stock'),
+    path('product/import', ProductImportView.as_view(), name='import-products'),
     path('product/delete', ProductBulkDeleteView.as_view(), name='bulk-delete-products'),
+    path('product/stats/', ProviderStatsView.as_view(), name='provider-stats'),
     path('products/', ProductListView.as_view(), name='product-list'),
     path('products/all/', AllProductsListView.as_view(), name='all-products-list'),
-    path('image/upload/', ImageUploadView.as_view(), name='image-upload'),
+    path('image/upload/', image_upload_view, name='image-upload'),
+    path('image/batch/', ImageBatchView.as_view(), name='image-batch'),
+    path('image/upload/init/', ImageUploadInitView.as_view(), name='image-upload-init'),
+    path('image/upload/direct/', ImageDirectUploadView.as_view(), name='image-upload-direct'),
+    path('image/upload/<uuid:uploadId>/', ImageUploadChunkView.as_view(), name='image-upload-chunk'),
+    path('image/upload/<uuid:uploadId>/complete/', ImageUploadCompleteView.as_view(), name='image-upload-complete'),
     path('image/<int:imageId>/', ImageDeleteView.as_view(), name='image-delete'),
-    path('image/<int:imageId>/download/', ImageDownloadView.as_view(), name='image-download'),
+    path('image/<int:imageId>/download/', image_download_view, name='image-download'),
+    path('storage/put/<str:token>/', LocalStoragePutView.as_view(), name='storage-put'),
 ]
@@ -1,6 +1,11 @@
-from django.db import transaction
-from django.db.models import F
-from django.http import FileResponse, Http404
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.db.models import ProtectedError
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status
@@ -15,18 +20,34 @@ from rest_framework.views import APIView
 
 from authorization.permissions import IsPackageMaker
 from authorization.permissions import IsProvider
+from events.outbox import publish_cache_invalidation
 from utils.cache_monitoring import MonitoredCacheMixin
 from utils.error_codes import ErrorCodes
 from utils.exceptions import ValidationError, PermissionError, ResourceNotFoundError
+from utils.serializers import parse_fields_param
+from utils.storage import LocalObjectStorage, get_image_storage
 from .filters import ProductFilter
-from .models import Image
+from .image_serving import serve_image
+from .image_variants import parse_variant_params, schedule_variants, select_variant
+from .imaging import hash_file, inspect_image
+from .importers import import_products, iter_csv_rows, iter_jsonl_rows
+from .models import Image, ImageReference
 from .models import Product
+from .models import ProviderStats
 from .pagination import CustomPagination
-from .serializers import ProductSerializer
+from .serializers import ProductSerializer, get_image_metadata
+from .stock import apply_stock_deltas
+from .upload_handlers import HashingMultiPartParser
+from .uploads import UploadOffsetMismatch, abort_upload, append_chunk, check_image_limits, complete_upload, \
+    get_upload, start_direct_upload, start_upload
 
 
 class ImageUploadView(APIView):
-    parser_classes = [MultiPartParser]
+    """
+    Upload an image. Uploads with the same content as an existing image return
+    that image's ID instead of storing the file again.
+    """
+    parser_classes = [HashingMultiPartParser]
 
     def post(self, request, *args, **kwargs):
         file = request.data.get('file')
@@ -35,8 +56,15 @@ class ImageUploadView(APIView):
                 {"status": "error", "message": "No file provided."},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        content_hash = getattr(file, 'content_hash', None) or hash_file(file)
+        content_type, width, height = inspect_image(file, file.name)
+        check_image_limits(content_type, width, height, file.size)
         # image = Image.objects.create(file=file, uploader=request.user)
-        image = Image.objects.create(file=file)
+        image, created = Image.store(
+            file, content_hash, request.user, content_type=content_type, width=width, height=height,
+        )
+        if created:
+            schedule_variants(image)
 
         return Response(
             {"status": "success",
@@ -56,14 +84,24 @@ class ImageDeleteView(APIView):
                 {"status": "error", "message": "Image not found.","code": "RES_001",},
                 status=status.HTTP_404_NOT_FOUND
             )
-        image.file.delete()
-        image.delete()
+        # Drops one of the caller's uploads, the file is only deleted with the last one
+        try:
+            image.release(request.user)
+        except ImageReference.DoesNotExist:
+            return Response(
+                {"status": "error", "message": "Image not found.","code": "RES_001",},
+                status=status.HTTP_404_NOT_FOUND
+            )
         return Response(
             {"status": "success", "message": "Image deleted successfully."},
             status=status.HTTP_200_OK
         )
 
 class ImageDownloadView(APIView):
+    """
+    Download an image. Passing the image's content hash as `?v=` makes the URL
+    content addressed, and the response is then cached as immutable.
+    """
     permission_classes = [AllowAny]
     
     def get(self, request, imageId, *args, **kwargs):
@@ -78,9 +116,225 @@ class ImageDownloadView(APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # Open the image file
-        file = image.file.open()
-        return FileResponse(file, content_type="image/jpeg")
+        versioned = bool(image.content_hash) and request.query_params.get('v') == image.content_hash
+        try:
+            variant_params = parse_variant_params(request.query_params)
+        except ValueError as e:
+            return Response(
+                {"status": "error",
+                 "message": str(e),
+                 "code": ErrorCodes.INVALID_INPUT,
+                 },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if variant_params is not None:
+            # Falls back to the original until the variants are generated,
+            # which mustn't be cached for good
+            variant = select_variant(image, *variant_params)
+            return serve_image(request, image, variant, immutable=versioned and variant is not None)
+
+        return serve_image(request, image, immutable=versioned)
+
+
+class ImageBatchView(APIView):
+    """
+    Resolve a list of image IDs, e.g. a package's photos, to their URLs,
+    dimensions, content hashes and variants: `image/batch/?ids=1,2,3`.
+    """
+    permission_classes = [AllowAny]
+    MAX_IDS = 100
+
+    def get(self, request):
+        try:
+            image_ids = [int(image_id) for image_id in request.query_params.get('ids', '').split(',') if image_id.strip()]
+        except ValueError:
+            raise ValidationError("ids must be a comma separated list of image IDs.")
+        if not image_ids:
+            raise ValidationError("ids must be a comma separated list of image IDs.")
+        if len(image_ids) > self.MAX_IDS:
+            raise ValidationError(f"At most {self.MAX_IDS} images can be requested at once.")
+
+        images = get_image_metadata(image_ids, request)
+        return Response({
+            'status': 'success',
+            'message': 'Images retrieved successfully',
+            'data': {
+                'images': [images[image_id] for image_id in dict.fromkeys(image_ids) if image_id in images],
+                'missing': [image_id for image_id in dict.fromkeys(image_ids) if image_id not in images],
+            }
+        }, status=status.HTTP_200_OK)
+
+class ImageUploadInitView(APIView):
+    """
+    Start a chunked, resumable image upload:
+
+    1. POST image/upload/init/ with the `filename` and total `size`
+    2. PATCH image/upload/<uploadId>/ with the next chunk as the raw body and
+       its position in the `Upload-Offset` header, repeated until all bytes are sent
+    3. POST image/upload/<uploadId>/complete/ to get the image ID
+
+    An interrupted upload is resumed by asking GET image/upload/<uploadId>/ for
+    the number of bytes received and sending the rest from there.
+    """
+    def post(self, request):
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            raise ValidationError("size must be a positive integer.")
+        upload = start_upload(request.user, str(request.data.get('filename') or 'image'), size)
+
+        return Response({
+            'status': 'success',
+            'message': 'Upload started',
+            'data': {
+                'uploadId': upload.id,
+                'size': upload.size,
+                'received': upload.received,
+                'chunkSize': settings.IMAGE_UPLOAD_CHUNK_SIZE,
+            }
+        }, status=status.HTTP_201_CREATED)
+
+
+class ImageUploadChunkView(APIView):
+    # No parsers: the chunk is read from the request stream, never request.data
+    parser_classes = []
+
+    def _upload_data(self, upload):
+        return {'uploadId': upload.id, 'size': upload.size, 'received': upload.received}
+
+    def get(self, request, uploadId):
+        upload = get_upload(request.user, uploadId)
+        return Response({
+            'status': 'success',
+            'message': 'Upload status',
+            'data': self._upload_data(upload),
+        }, status=status.HTTP_200_OK)
+
+    def patch(self, request, uploadId):
+        upload = get_upload(request.user, uploadId)
+        if not request.headers.get('Content-Length'):
+            raise ValidationError("Content-Length is required.")
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+            length = int(request.headers.get('Content-Length', ''))
+        except ValueError:
+            raise ValidationError("Upload-Offset and Content-Length must be integers.")
+        if length <= 0:
+            raise ValidationError("Content-Length must be a positive integer.")
+
+        try:
+            append_chunk(upload, offset, request.stream, length)
+        except UploadOffsetMismatch as e:
+            return Response({
+                'status': 'error',
+                'message': str(e),
+                'code': ErrorCodes.CONFLICT,
+                'data': {'uploadId': upload.id, 'size': upload.size, 'received': e.received},
+            }, status=status.HTTP_409_CONFLICT)
+
+        return Response({
+            'status': 'success',
+            'message': 'Chunk received',
+            'data': self._upload_data(upload),
+        }, status=status.HTTP_200_OK)
+
+    def delete(self, request, uploadId):
+        abort_upload(get_upload(request.user, uploadId))
+        return Response({
+            'status': 'success',
+            'message': 'Upload cancelled',
+        }, status=status.HTTP_200_OK)
+
+
+class ImageDirectUploadView(APIView):
+    """
+    Start an upload straight to the image storage, for object storage backends.
+    The client sends the `filename`, `size`, `contentType` and hex `sha256` of the
+    file, uploads it to the returned presigned URL, then completes it with
+    POST image/upload/<uploadId>/complete/. If the same content was uploaded
+    before, its image ID is returned right away and nothing has to be sent.
+    """
+    def post(self, request):
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            raise ValidationError("size must be a positive integer.")
+        image, upload, instructions = start_direct_upload(
+            request.user,
+            str(request.data.get('filename') or 'image'),
+            size,
+            str(request.data.get('contentType') or ''),
+            request.data.get('sha256') or '',
+        )
+
+        if image is not None:
+            return Response({
+                'status': 'success',
+                'message': 'Image already uploaded',
+                'data': {'imageId': image.id, 'upload': None},
+            }, status=status.HTTP_200_OK)
+
+        instructions['url'] = request.build_absolute_uri(instructions['url'])
+        return Response({
+            'status': 'success',
+            'message': 'Upload the file to the given URL, then complete the upload',
+            'data': {
+                'imageId': None,
+                'upload': {'uploadId': upload.id, 'expiresIn': settings.IMAGE_STORAGE_URL_EXPIRY, **instructions},
+            },
+        }, status=status.HTTP_201_CREATED)
+
+
+class LocalStoragePutView(APIView):
+    """
+    Where LocalObjectStorage presigned URLs upload to, standing in for the
+    object store: the body is stored under the signed name if its size and
+    SHA-256 are the signed ones.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    parser_classes = []
+
+    def put(self, request, token):
+        storage = get_image_storage()
+        if not isinstance(storage, LocalObjectStorage):
+            raise ResourceNotFoundError("Not found.")
+        try:
+            allowed = storage.check_put_token(token)
+        except signing.BadSignature:
+            raise PermissionError("Invalid or expired upload URL.")
+        if int(request.headers.get('Content-Length') or 0) != allowed['size']:
+            raise ValidationError(f"The upload URL is for a file of {allowed['size']} bytes.")
+
+        digest = hashlib.sha256()
+        with tempfile.TemporaryFile() as file:
+            for chunk in iter(lambda: request.stream.read(64 * 1024), b''):
+                digest.update(chunk)
+                file.write(chunk)
+            if digest.hexdigest() != allowed['sha256']:
+                raise ValidationError("The content doesn't match the signed SHA-256 checksum.")
+            # Content addressed: an existing file has the same content
+            if not storage.exists(allowed['name']):
+                file.seek(0)
+                storage.save(allowed['name'], File(file))
+
+        return Response({
+            'status': 'success',
+            'message': 'File stored',
+        }, status=status.HTTP_200_OK)
+
+class ImageUploadCompleteView(APIView):
+    def post(self, request, uploadId):
+        image, created = complete_upload(get_upload(request.user, uploadId))
+        if created:
+            schedule_variants(image)
+
+        return Response(
+            {"status": "success",
+                "message": "Here is your image :)",
+             "imageId": image.id},
+            status=status.HTTP_200_OK
+        )
 
 
 # Create your views here.
@@ -111,7 +365,108 @@ class ProductCreateView(APIView):
                 raise e
             raise ValidationError(str(e))
 
-class ProductListView(MonitoredCacheMixin, ListAPIView):
+class ProductImportView(APIView):
+    """
+    Create or update many products at once from a JSON Lines or CSV body, or an
+    uploaded `file`. Rows with an `id` update the provider's existing product.
+    """
+    permission_classes = [IsAuthenticated, IsProvider]
+    parser_classes = [MultiPartParser]
+
+    JSONL_CONTENT_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-lines', 'application/x-jsonlines')
+    CSV_CONTENT_TYPES = ('text/csv', 'application/csv')
+
+    def _get_rows(self, request):
+        import_format = request.query_params.get('importFormat')
+
+        if request.content_type.startswith('multipart/form-data'):
+            upload = request.data.get('file')
+            if not upload:
+                return None
+            lines = upload
+            if import_format is None:
+                import_format = 'csv' if upload.name.lower().endswith('.csv') else 'jsonl'
+        else:
+            # Read the body line by line instead of loading it all into memory
+            lines = request.stream or []
+            if import_format is None:
+                content_type = request.content_type.split(';')[0].strip()
+                if content_type in self.CSV_CONTENT_TYPES:
+                    import_format = 'csv'
+                elif content_type in self.JSONL_CONTENT_TYPES:
+                    import_format = 'jsonl'
+
+        if import_format == 'csv':
+            return iter_csv_rows(lines)
+        if import_format == 'jsonl':
+            return iter_jsonl_rows(lines)
+        return None
+
+    def post(self, request):
+        try:
+            rows = self._get_rows(request)
+            if rows is None:
+                return Response({
+                    'status': 'error',
+                    'message': 'Send products as JSON Lines or CSV, in the body or as a file.',
+                    'code': ErrorCodes.INVALID_INPUT,
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            result = import_products(
+                request.user.provider_profile,
+                rows,
+                chunk_size=settings.PRODUCT_IMPORT_CHUNK_SIZE,
+                max_rows=settings.PRODUCT_IMPORT_MAX_ROWS,
+            )
+
+            return Response({
+                'status': 'success',
+                'message': 'Products imported successfully' if not result['failed'] else 'Products imported with errors',
+                'data': result
+            }, status=status.HTTP_200_OK)
+
+        except UnicodeDecodeError:
+            raise ValidationError('Import file must be UTF-8 encoded')
+        except Exception as e:
+            if isinstance(e, (ValidationError, PermissionError)):
+                raise e
+            raise ValidationError(str(e))
+
+class ProductListProjectionMixin:
+    """
+    Serve product lists with only the columns the response needs. The long
+    `description` is left out unless asked for, e.g. `?fields=id,name,description`.
+    `?expand=images` returns image metadata instead of image IDs.
+    """
+    list_fields = [field for field in ProductSerializer.Meta.fields if field != 'description']
+
+    def get_list_fields(self):
+        if not hasattr(self, '_list_fields'):
+            self._list_fields = parse_fields_param(self.request, ProductSerializer.Meta.fields, default=self.list_fields)
+        return self._list_fields
+
+    def get_expand(self):
+        return parse_fields_param(self.request, ProductSerializer.expandable_image_fields, default=[], param='expand')
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs['fields'] = self.get_list_fields()
+        kwargs['expand'] = self.get_expand()
+        if 'images' in kwargs['expand'] and 'images' in kwargs['fields'] and args:
+            # The images of the whole page in one query
+            context = self.get_serializer_context()
+            context['images'] = get_image_metadata(
+                (image_id for product in args[0] for image_id in product.image_ids), self.request
+            )
+            kwargs['context'] = context
+        return super().get_serializer(*args, **kwargs)
+
+    def project(self, queryset):
+        fields = self.get_list_fields()
+        if 'images' in fields:
+            queryset = queryset.prefetch_related('image_links')
+        return queryset.only('id', *[field for field in fields if field != 'images'])
+
+class ProductListView(ProductListProjectionMixin, MonitoredCacheMixin, ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = ProductSerializer
     filter_backends = [DjangoFilterBackend, SearchFilter]
@@ -140,7 +495,7 @@ class ProductListView(MonitoredCacheMixin, ListAPIView):
             if is_active_param is None:
                 queryset = queryset.filter(isActive=True)
             
-            return queryset
+            return self.project(queryset)
         return Product.objects.none()
 
 class ProductDetailsView(MonitoredCacheMixin, APIView):
@@ -157,7 +512,7 @@ class ProductDetailsView(MonitoredCacheMixin, APIView):
     
     def get(self, request, product_id):
         try:
-            product = get_object_or_404(Product, id=product_id)
+            product = get_object_or_404(Product.objects, id=product_id)
             
             # Check if the user is the provider of the product or a package maker
             is_provider = hasattr(request.user, 'provider_profile') and product.provider == request.user.provider_profile
@@ -200,7 +555,7 @@ class ProductDetailsView(MonitoredCacheMixin, APIView):
 
     def put(self, request, product_id):
         try:
-            product = get_object_or_404(Product, id=product_id)
+            product = get_object_or_404(Product.objects, id=product_id)
         except Http404:
             return Response({
                 'status': 'error',
@@ -340,7 +695,7 @@ class ProductDeactivateView(APIView):
                 raise e
             raise ValidationError(str(e))
 
-class AllProductsListView(MonitoredCacheMixin, ListAPIView):
+class AllProductsListView(ProductListProjectionMixin, MonitoredCacheMixin, ListAPIView):
     permission_classes = [IsAuthenticated, IsPackageMaker]
     serializer_class = ProductSerializer
     filter_backends = [DjangoFilterBackend, SearchFilter]
@@ -362,60 +717,106 @@ class AllProductsListView(MonitoredCacheMixin, ListAPIView):
         return super().list(request, *args, **kwargs)
         
     def get_queryset(self):
-        return Product.objects.filter(isActive=True)
+        return self.project(Product.objects.filter(isActive=True))
+
+class ProviderStatsView(APIView):
+    """
+    Product summary of the provider per category, read from the ProviderStats table.
+    """
+    permission_classes = [IsAuthenticated, IsProvider]
+
+    SUMMARY_FIELDS = ('products_count', 'active_count', 'stock_total', 'packaged_count')
+
+    def get(self, request):
+        categories = list(
+            ProviderStats.objects
+            .filter(provider=request.user.provider_profile)
+            .order_by('category')
+            .values('category', *self.SUMMARY_FIELDS)
+        )
+        totals = {field: sum(row[field] for row in categories) for field in self.SUMMARY_FIELDS}
+
+        return Response({
+            'status': 'success',
+            'message': 'Provider stats retrieved successfully',
+            'data': {
+                'categories': categories,
+                'totals': totals,
+            }
+        }, status=status.HTTP_200_OK)
 
 class ProductChangeStockView(APIView):
+    """
+    Change the stock of many products in one request, either with per-product
+    deltas (`{"deltas": {"<id>": <delta>}, "allowPartial": false}`) or with the
+    same `stockChange` for every product in `updates`.
+    """
     permission_classes = [IsAuthenticated, IsProvider]
 
-    def patch(self, request):
-        try:
-            data = request.data
+    def _get_deltas(self, data):
+        if 'deltas' in data:
+            deltas = data.get('deltas')
+            if not isinstance(deltas, dict) or not deltas:
+                return None
+            items = deltas.items()
+        else:
             updates = data.get('updates', [])
             stock_change = data.get('stockChange', None)
+            if not updates or stock_change is None or not isinstance(updates, list):
+                return None
+            items = ((product_id, stock_change) for product_id in updates)
+
+        parsed = {}
+        for product_id, delta in items:
+            if isinstance(delta, bool) or not isinstance(delta, int):
+                return None
+            try:
+                parsed[int(product_id)] = delta
+            except (ValueError, TypeError):
+                return None
+        return parsed
 
-            if not updates or stock_change is None:
+    def patch(self, request):
+        try:
+            deltas = self._get_deltas(request.data)
+            if deltas is None:
                 return Response({
                     'status': 'error',
-                    'message': 'Invalid input data. Both updates and stockChange are required.',
+                    'message': 'Invalid input data. Either deltas, or both updates and stockChange are required.',
                     'code': ErrorCodes.INVALID_INPUT,
                 }, status=status.HTTP_400_BAD_REQUEST)
 
-            product_ids = [update for update in updates]
-
-            # Use SELECT FOR UPDATE to lock rows and prevent race conditions
-            with transaction.atomic():
-                products = (
-                    Product.objects
-                    .select_for_update()
-                    .filter(id__in=product_ids, provider=request.user.provider_profile)
-                )
+            applied, results = apply_stock_deltas(
+                request.user.provider_profile,
+                deltas,
+                allow_partial=request.data.get('allowPartial', False) is True,
+            )
 
-                if products.count() != len(product_ids):
+            if not applied:
+                not_found = [result['id'] for result in results if result['status'] == 'not_found']
+                if not_found:
                     return Response({
                         'status': 'error',
                         'message': 'One or more products not found or you do not have permission to update them.',
                         'code': ErrorCodes.NOT_FOUND,
+                        'data': {'results': results},
                     }, status=status.HTTP_400_BAD_REQUEST)
 
-                # Ensure stock does not go negative before updating
-                insufficient_stock = [
-                    product.id for product in products
-                    if product.stock + stock_change < 0
-                ]
-
-                if insufficient_stock:
-                    return Response({
-                        'status': 'error',
-                        'message': f'Insufficient stock for products {insufficient_stock}. Stock cannot go negative.',
-                        'code': ErrorCodes.INVALID_INPUT,
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-                # Update stock atomically using F expressions
-                Product.objects.filter(id__in=product_ids).update(stock=F('stock') + stock_change)
+                insufficient_stock = [result['id'] for result in results if result['status'] == 'insufficient_stock']
+                return Response({
+                    'status': 'error',
+                    'message': f'Insufficient stock for products {insufficient_stock}. Stock cannot go negative.',
+                    'code': ErrorCodes.INVALID_INPUT,
+                    'data': {'results': results},
+                }, status=status.HTTP_400_BAD_REQUEST)
 
             return Response({
                 'status': 'success',
                 'message': 'Stock quantities updated successfully.',
+                'data': {
+                    'updated': sum(1 for result in results if result['status'] == 'updated'),
+                    'results': results,
+                },
             }, status=status.HTTP_200_OK)
 
         except Exception as e:
@@ -424,16 +825,38 @@ class ProductChangeStockView(APIView):
             raise ValidationError(str(e))
 
 class ProductBulkDeleteView(APIView):
+    """
+    Delete many products of the provider. IDs are given as `productIds`, either
+    comma separated in the query string or as a list in the body.
+
+    By default products are soft deleted (tombstoned) and hard deleted later by
+    the purge_products command; `mode=hard` deletes them right away.
+    """
     permission_classes = [IsAuthenticated, IsProvider]
 
+    def _get_product_ids(self, request):
+        product_ids = request.data.get('productIds') if hasattr(request.data, 'get') else None
+        if product_ids is None:
+            product_ids = [
+                product_id for product_id in request.query_params.get('productIds', '').split(',')
+                if product_id.strip()
+            ]
+        if not isinstance(product_ids, list):
+            return None
+        try:
+            return {int(product_id) for product_id in product_ids}
+        except (ValueError, TypeError):
+            return None
+
     def delete(self, request):
         try:
-            product_ids = request.query_params.get('productIds', '').split(',')
+            product_ids = self._get_product_ids(request)
+            mode = request.query_params.get('mode') or (request.data.get('mode') if hasattr(request.data, 'get') else None) or 'soft'
 
-            if not product_ids:
+            if not product_ids or mode not in ('soft', 'hard'):
                 return Response({
                     'status': 'error',
-                    'message': 'Invalid product IDs.',
+                    'message': 'Invalid product IDs.' if not product_ids else 'Invalid mode, use soft or hard.',
                     'code': ErrorCodes.INVALID_INPUT,
                 }, status=status.HTTP_400_BAD_REQUEST)
 
@@ -446,8 +869,18 @@ class ProductBulkDeleteView(APIView):
                     'code': ErrorCodes.NOT_FOUND,
                 }, status=status.HTTP_404_NOT_FOUND)
 
-            # Delete the products
-            products.delete()
+            if mode == 'soft':
+                products.soft_delete()
+            else:
+                try:
+                    products.delete()
+                except ProtectedError:
+                    return Response({
+                        'status': 'error',
+                        'message': 'One or more products are used by trip packages and cannot be deleted.',
+                        'code': ErrorCodes.INVALID_INPUT,
+                    }, status=status.HTTP_400_BAD_REQUEST)
+                publish_cache_invalidation('product', related_models=['package'])
 
             return Response({
                 'status': 'success',
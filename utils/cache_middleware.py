@@ -1,22 +1,49 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.utils.cache import patch_response_headers
 from django.conf import settings
+from .cache_utils import async_coalesced_invalidation, coalesced_invalidation
 
 class CacheControlMiddleware:
     """
     Middleware to add Cache-Control headers to responses.
     """
+    sync_capable = True
+    async_capable = True
     
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
         
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.get_response(request)
-        
+        if self.needs_user(request, response):
+            return self.process_response(request, response, request.user.is_authenticated)
+        return self.process_response(request, response)
+    
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if self.needs_user(request, response):
+            # auser() doesn't block the event loop like request.user would
+            user = await request.auser()
+            return self.process_response(request, response, user.is_authenticated)
+        return self.process_response(request, response)
+    
+    def needs_user(self, request, response):
+        return not request.path.startswith('/admin/') and not response.has_header('Cache-Control')
+    
+    def process_response(self, request, response, is_authenticated=False):
         if request.path.startswith('/admin/'):
             patch_response_headers(response, cache_timeout=0)
             return response
             
-        if request.user.is_authenticated:
+        # Views that set their own caching policy, e.g. image downloads
+        if response.has_header('Cache-Control'):
+            return response
+            
+        if is_authenticated:
             patch_response_headers(response, cache_timeout=0)
             return response
             
@@ -24,4 +51,27 @@ class CacheControlMiddleware:
             cache_timeout = getattr(settings, 'CACHE_MIDDLEWARE_SECONDS', 300)
             patch_response_headers(response, cache_timeout=cache_timeout)
             
-        return response 
\ No newline at end of file
+        return response
+
+class CacheInvalidationMiddleware:
+    """
+    Middleware that collects the cache invalidations triggered while handling
+    a request and applies them once, deduplicated, when the request is done.
+    """
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with coalesced_invalidation():
+            return self.get_response(request)
+    
+    async def __acall__(self, request):
+        async with async_coalesced_invalidation():
+            return await self.get_response(request)
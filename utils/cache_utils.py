@@ -1,6 +1,10 @@
 from django.core.cache import cache
+from django.db import connection, transaction
 from django.utils.encoding import force_str
 from django.conf import settings
+from asgiref.local import Local
+from asgiref.sync import sync_to_async
+from contextlib import asynccontextmanager, contextmanager
 import hashlib
 import json
 
@@ -183,60 +187,158 @@ def get_view_cache_key_pattern(view_name):
     """
     return f"view_cache:*{view_name}*"
 
+def get_model_cache_patterns(model_name, instance_id=None, related_models=None):
+    """
+    Get the cache key patterns to delete when a model changes.
+    
+    Args:
+        model_name (str): The name of the model (e.g., 'product', 'package')
+        instance_id (int, optional): The ID of the specific instance
+        related_models (list, optional): List of related model names to invalidate
+        
+    Returns:
+        tuple: (list of patterns, whether the entire cache has to be cleared)
+    """
+    patterns = []
+    
+    patterns.append(f"view_cache:*{model_name}_list*")
+    patterns.append(f"view_cache:*{model_name}s_list*")
+    patterns.append(f"view_cache:*all_{model_name}s*")
+    
+    if instance_id:
+        patterns.append(f"view_cache:*{model_name}_detail*")
+        patterns.append(f"view_cache:*{model_name}*{instance_id}*")
+    
+    if related_models:
+        for related_model in related_models:
+            patterns.append(f"view_cache:*{related_model}_list*")
+            patterns.append(f"view_cache:*{related_model}s_list*")
+            patterns.append(f"view_cache:*all_{related_model}s*")
+    
+    if model_name == 'package':
+        patterns.append(f"view_cache:*package_list*")
+        patterns.append(f"view_cache:*package_detail*")
+        patterns.append(f"view_cache:*user_purchase_history*")
+    elif model_name == 'product':
+        patterns.append(f"view_cache:*product_list*")
+        patterns.append(f"view_cache:*product_detail*")
+        patterns.append(f"view_cache:*all_products_list*")
+        patterns.append(f"view_cache:*package_list*")
+        patterns.append(f"view_cache:*package_detail*")
+    elif model_name == 'image':
+        # No need to invalidate image download cache as it's no longer cached
+        pass
+    
+    clear_all = model_name in ['product', 'package', 'transaction', 'purchasehistory']
+    return patterns, clear_all
+
+_invalidation_state = Local()
+
+def _pending_invalidations():
+    if not hasattr(_invalidation_state, 'pending'):
+        _invalidation_state.pending = set()
+        _invalidation_state.depth = 0
+    return _invalidation_state.pending
+
 def invalidate_model_caches(model_name, instance_id=None, related_models=None):
     """
     Invalidate all caches related to a specific model and its related models.
     
+    Invalidations are collected and applied once, deduplicated:
+    - at the end of a coalesced_invalidation() block (e.g. the current request),
+    - otherwise when the current transaction.atomic block commits,
+    - otherwise immediately.
+    
     Args:
         model_name (str): The name of the model (e.g., 'product', 'package')
         instance_id (int, optional): The ID of the specific instance
         related_models (list, optional): List of related model names to invalidate
     """
-    if hasattr(cache, 'client') and hasattr(cache.client, 'get_client'):
-        redis_client = cache.client.get_client()
-        
-        patterns = []
-        
-        patterns.append(f"view_cache:*{model_name}_list*")
-        patterns.append(f"view_cache:*{model_name}s_list*")
-        patterns.append(f"view_cache:*all_{model_name}s*")
-        
-        if instance_id:
-            patterns.append(f"view_cache:*{model_name}_detail*")
-            patterns.append(f"view_cache:*{model_name}*{instance_id}*")
-        
-        if related_models:
-            for related_model in related_models:
-                patterns.append(f"view_cache:*{related_model}_list*")
-                patterns.append(f"view_cache:*{related_model}s_list*")
-                patterns.append(f"view_cache:*all_{related_model}s*")
-        
-        if model_name == 'package':
-            patterns.append(f"view_cache:*package_list*")
-            patterns.append(f"view_cache:*package_detail*")
-            patterns.append(f"view_cache:*user_purchase_history*")
-        elif model_name == 'product':
-            patterns.append(f"view_cache:*product_list*")
-            patterns.append(f"view_cache:*product_detail*")
-            patterns.append(f"view_cache:*all_products_list*")
-            patterns.append(f"view_cache:*package_list*")
-            patterns.append(f"view_cache:*package_detail*")
-        elif model_name == 'image':
-            # No need to invalidate image download cache as it's no longer cached
-            pass
-        
-        print(f"Invalidating cache patterns: {patterns}")
-        
-        for pattern in patterns:
-            cursor = '0'
-            while cursor != 0:
-                cursor, keys = redis_client.scan(cursor=cursor, match=pattern, count=100)
-                if keys:
-                    print(f"Deleting keys: {keys}")
-                    redis_client.delete(*keys)
-                if cursor == '0' or cursor == 0:
-                    break
-        
-        if model_name in ['product', 'package', 'transaction', 'purchasehistory']:
-            print("Important model change detected, clearing entire cache")
-            cache.clear() 
\ No newline at end of file
+    _pending_invalidations().add((model_name, instance_id, tuple(related_models or ())))
+    
+    if _invalidation_state.depth > 0:
+        return
+    if connection.in_atomic_block:
+        transaction.on_commit(flush_cache_invalidations)
+        return
+    flush_cache_invalidations()
+
+def flush_cache_invalidations():
+    """
+    Apply the collected invalidations. Each pattern is scanned once, and when
+    the entire cache has to be cleared the pattern scans are skipped.
+    """
+    pending = _pending_invalidations()
+    if not pending:
+        return
+    entries = list(pending)
+    pending.clear()
+    
+    if not (hasattr(cache, 'client') and hasattr(cache.client, 'get_client')):
+        return
+    
+    patterns = []
+    clear_all = False
+    for model_name, instance_id, related_models in entries:
+        entry_patterns, entry_clear_all = get_model_cache_patterns(model_name, instance_id, list(related_models))
+        clear_all = clear_all or entry_clear_all
+        for pattern in entry_patterns:
+            if pattern not in patterns:
+                patterns.append(pattern)
+    
+    if clear_all:
+        print(f"Important model change detected for {len(entries)} invalidations, clearing entire cache")
+        cache.clear()
+        return
+    
+    redis_client = cache.client.get_client()
+    
+    print(f"Invalidating cache patterns: {patterns}")
+    
+    for pattern in patterns:
+        cursor = '0'
+        while cursor != 0:
+            cursor, keys = redis_client.scan(cursor=cursor, match=pattern, count=100)
+            if keys:
+                print(f"Deleting keys: {keys}")
+                redis_client.delete(*keys)
+            if cursor == '0' or cursor == 0:
+                break
+
+@contextmanager
+def coalesced_invalidation():
+    """
+    Collect the invalidate_model_caches calls made inside the block and apply
+    them once, deduplicated, when the outermost block exits.
+    
+    Usage:
+        with coalesced_invalidation():
+            product.save()
+            package.save()
+    """
+    _pending_invalidations()
+    _invalidation_state.depth += 1
+    try:
+        yield
+    finally:
+        _invalidation_state.depth -= 1
+        if _invalidation_state.depth == 0:
+            if connection.in_atomic_block:
+                transaction.on_commit(flush_cache_invalidations)
+            else:
+                flush_cache_invalidations()
+
+@asynccontextmanager
+async def async_coalesced_invalidation():
+    """
+    coalesced_invalidation() for async code. The collected invalidations are
+    applied in a thread, as the cache client is synchronous.
+    """
+    pending = _pending_invalidations()
+    _invalidation_state.depth += 1
+    try:
+        yield
+    finally:
+        _invalidation_state.depth -= 1
+        if _invalidation_state.depth == 0 and pending:
+            await sync_to_async(flush_cache_invalidations)()
@@ -16,4 +16,5 @@ class ErrorCodes:
     
     # Resource Errors (4xxx)
     NOT_FOUND = "RES_001"
-    ALREADY_EXISTS = "RES_002"
\ No newline at end of file
+    ALREADY_EXISTS = "RES_002"
+    CONFLICT = "RES_003"
\ No newline at end of file
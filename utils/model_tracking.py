@@ -0,0 +1,96 @@
+import copy
+
+from django.db.models.base import DEFERRED
+
+
+class FieldTrackerMixin:
+    """
+    A model mixin that remembers the values of `tracked_fields` as they were
+    loaded from the database, so a save can tell which fields changed without
+    querying the row again.
+
+    The original values are kept as a tuple in `tracked_fields` order. Fields
+    that were deferred when the instance was loaded are reported as changed.
+
+    Usage:
+        class MyModel(FieldTrackerMixin, models.Model):
+            tracked_fields = ('status', 'owner_id')  # attribute names (use `<fk>_id` for foreign keys)
+    """
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_tracked_fields()
+        return instance
+
+    def _snapshot_tracked_fields(self, fields=None):
+        current = tuple(self._copy_value(self.__dict__.get(name, DEFERRED)) for name in self.tracked_fields)
+        if fields is None or getattr(self, '_original_values', None) is None:
+            self._original_values = current
+        else:
+            fields = set(fields)
+            self._original_values = tuple(
+                value if self._field_in(name, fields) else original
+                for name, value, original in zip(self.tracked_fields, current, self._original_values)
+            )
+
+    @staticmethod
+    def _field_in(name, fields):
+        # fields may use field names ('flight') or attribute names ('flight_id')
+        return name in fields or name.removesuffix('_id') in fields
+
+    @staticmethod
+    def _copy_value(value):
+        # JSON fields hold mutable lists/dicts that may be changed in place
+        if isinstance(value, (list, dict)):
+            return copy.deepcopy(value)
+        return value
+
+    @property
+    def is_tracked(self):
+        """Whether the original values of this instance are known"""
+        return getattr(self, '_original_values', None) is not None
+
+    def get_original_value(self, field_name):
+        """
+        Get the value a tracked field had when the instance was loaded.
+        Returns DEFERRED if it is unknown.
+        """
+        if not self.is_tracked:
+            return DEFERRED
+        return self._original_values[self.tracked_fields.index(field_name)]
+
+    def has_changed(self, field_name):
+        original = self.get_original_value(field_name)
+        if original is DEFERRED:
+            return True
+        return self.__dict__.get(field_name, DEFERRED) != original
+
+    def changed_fields(self):
+        return {name for name in self.tracked_fields if self.has_changed(name)}
+
+    def has_tracked_changes(self, update_fields=None):
+        """
+        Whether saving would write a change to any tracked field.
+        New instances and instances loaded without tracking always count as changed.
+
+        Args:
+            update_fields (iterable, optional): The update_fields passed to save()
+        """
+        if self._state.adding or not self.is_tracked:
+            return True
+
+        changed = self.changed_fields()
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            changed = {name for name in changed if self._field_in(name, update_fields)}
+        return bool(changed)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._snapshot_tracked_fields(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self._snapshot_tracked_fields(fields)
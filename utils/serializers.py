@@ -0,0 +1,48 @@
+from .exceptions import ValidationError
+
+
+class DynamicFieldsMixin:
+    """
+    A serializer mixin that takes an optional `fields` argument and only
+    outputs those fields.
+
+    Usage:
+        class MySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+            ...
+
+        MySerializer(queryset, many=True, fields=['id', 'name'])
+    """
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+
+def parse_fields_param(request, allowed, default=None, param='fields'):
+    """
+    Read a comma separated list of field names from a query parameter.
+
+    Args:
+        request: The DRF request
+        allowed (iterable): Field names clients may ask for
+        default (iterable, optional): Fields used when the parameter is missing, all allowed fields if None
+        param (str): Name of the query parameter
+
+    Returns:
+        list: The requested field names, in `allowed` order
+
+    Raises:
+        ValidationError: If an unknown field is requested
+    """
+    value = request.query_params.get(param)
+    if not value:
+        return list(default if default is not None else allowed)
+
+    requested = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = requested - set(allowed)
+    if unknown:
+        raise ValidationError(f"Unknown {param}: {', '.join(sorted(unknown))}")
+    return [name for name in allowed if name in requested]
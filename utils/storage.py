@@ -0,0 +1,255 @@
+import base64
+import io
+import mimetypes
+
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage, storages
+from django.urls import reverse
+from django.utils.deconstruct import deconstructible
+
+READ_BUFFER_SIZE = 64 * 1024
+PUT_TOKEN_SALT = 'utils.storage.put'
+
+
+def get_image_storage():
+    """The storage of uploaded images and their variants, STORAGES['images']"""
+    return storages['images']
+
+
+def supports_direct_upload(storage):
+    """Whether clients can upload to the storage with a presigned URL"""
+    return hasattr(storage, 'presigned_put')
+
+
+class _S3ObjectReader(io.RawIOBase):
+    """
+    Read-only, seekable view of an S3 object. Reads are streamed from a single
+    GET request, seeking starts a new ranged request.
+    """
+    def __init__(self, storage, key):
+        self._storage = storage
+        self._key = key
+        self._position = 0
+        self._size = None
+        self._body = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _get_size(self):
+        if self._size is None:
+            self._size = self._storage.client.head_object(
+                Bucket=self._storage.bucket_name, Key=self._key,
+            )['ContentLength']
+        return self._size
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._get_size()
+        if offset != self._position:
+            self._close_body()
+            self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def readinto(self, buffer):
+        if self._body is None:
+            if self._position >= self._get_size():
+                return 0
+            kwargs = {'Range': f'bytes={self._position}-'} if self._position else {}
+            self._body = self._storage.client.get_object(
+                Bucket=self._storage.bucket_name, Key=self._key, **kwargs,
+            )['Body']
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+@deconstructible
+class S3Storage(Storage):
+    """
+    Storage on an S3 compatible object store (AWS S3, MinIO, Ceph...), needs boto3.
+
+    Files are written with boto3's managed transfers, which switch to multipart
+    uploads for large files. Downloads and direct uploads go through presigned
+    URLs, so app workers aren't in the byte path.
+    """
+    def __init__(self, bucket_name=None, endpoint_url=None, region_name=None,
+                 access_key=None, secret_key=None, location='', url_expiry=3600):
+        if not bucket_name:
+            raise ImproperlyConfigured("S3Storage needs a bucket_name.")
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self.region_name = region_name
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.location = location.strip('/')
+        self.url_expiry = url_expiry
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+                from botocore.config import Config
+            except ImportError:
+                raise ImproperlyConfigured("The S3 image storage needs boto3, install it with `pip install boto3`.")
+            self._client = boto3.client(
+                's3',
+                endpoint_url=self.endpoint_url,
+                region_name=self.region_name,
+                aws_access_key_id=self.access_key,
+                aws_secret_access_key=self.secret_key,
+                config=Config(signature_version='s3v4'),
+            )
+        return self._client
+
+    def _key(self, name):
+        name = name.replace('\\', '/')
+        return f"{self.location}/{name}" if self.location else name
+
+    def _head(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=self._key(name))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode:
+            raise ValueError("S3 files are read-only, write them with save().")
+        reader = _S3ObjectReader(self, self._key(name))
+        return File(io.BufferedReader(reader, buffer_size=READ_BUFFER_SIZE), name)
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        extra_args = {}
+        content_type = getattr(content, 'content_type', None) or mimetypes.guess_type(name)[0]
+        if content_type:
+            extra_args['ContentType'] = content_type
+        self.client.upload_fileobj(content, self.bucket_name, self._key(name), ExtraArgs=extra_args)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Overwrite like S3 itself does, image file names are content addressed
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket_name, Key=self._key(name))
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def size(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head['ContentLength']
+
+    def get_modified_time(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head['LastModified']
+
+    def url(self, name, expire=None):
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket_name, 'Key': self._key(name)},
+            ExpiresIn=expire or self.url_expiry,
+        )
+
+    def presigned_put(self, name, content_type, size, sha256, expire=None):
+        """
+        A URL the client uploads a file to directly. The object store checks
+        the size and the SHA-256 checksum, so the stored object is exactly the
+        announced one.
+
+        Args:
+            name (str): Name of the file in the storage
+            content_type (str): MIME type of the file
+            size (int): Size in bytes
+            sha256 (str): Hex SHA-256 of the content
+            expire (int, optional): Seconds the URL is valid
+
+        Returns:
+            dict: 'url', 'method' and the 'headers' the upload must be sent with
+        """
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        url = self.client.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': self.bucket_name,
+                'Key': self._key(name),
+                'ContentType': content_type,
+                'ContentLength': size,
+                'ChecksumSHA256': checksum,
+            },
+            ExpiresIn=expire or self.url_expiry,
+        )
+        return {
+            'url': url,
+            'method': 'PUT',
+            'headers': {'Content-Type': content_type, 'x-amz-checksum-sha256': checksum},
+        }
+
+
+@deconstructible
+class LocalObjectStorage(FileSystemStorage):
+    """
+    FileSystemStorage with the presigned uploads of S3Storage, to develop and
+    test direct uploads without an object store. The upload URLs point to
+    LocalStoragePutView, which checks the signature, size and checksum the
+    way S3 would.
+    """
+    def __init__(self, *args, url_expiry=3600, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.url_expiry = url_expiry
+
+    def presigned_put(self, name, content_type, size, sha256, expire=None):
+        token = signing.dumps(
+            {'name': name, 'size': size, 'sha256': sha256, 'expire': expire or self.url_expiry},
+            salt=PUT_TOKEN_SALT,
+        )
+        return {
+            'url': reverse('storage-put', args=[token]),
+            'method': 'PUT',
+            'headers': {'Content-Type': content_type},
+        }
+
+    def check_put_token(self, token):
+        """
+        The upload a presigned URL token allows.
+
+        Returns:
+            dict: 'name', 'size' and 'sha256' of the file
+
+        Raises:
+            signing.BadSignature: If the token is invalid or expired
+        """
+        payload = signing.loads(token, salt=PUT_TOKEN_SALT)
+        # Checked again with the expiry it was created with
+        return signing.loads(token, salt=PUT_TOKEN_SALT, max_age=payload['expire'])